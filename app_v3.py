@@ -3,31 +3,31 @@ import os
 import re
 import time
 import threading
+import queue
+import heapq
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from typing import Optional
 from datetime import datetime, date, timezone, timedelta
-from functools import wraps
+from functools import wraps, lru_cache
+from operator import itemgetter
 import logging
 
 from flask import (
-    Flask, render_template, redirect, url_for, flash, request, abort, jsonify
+    Flask, render_template, redirect, url_for, flash, request, abort, has_request_context, stream_with_context
 )
 from flask_sqlalchemy import SQLAlchemy
+from jinja2 import FileSystemBytecodeCache
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
-from apscheduler.schedulers.background import BackgroundScheduler
 from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
 
+import orjson
 import requests
-import smtplib
-from email.message import EmailMessage
-import pandas as pd
+from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
-from sqlalchemy import case, extract
-
-# Telegram imports
-from telegram import Update
-from telegram.ext import Application
+from sqlalchemy import case, extract, event, inspect, text, tuple_
+from sqlalchemy.orm import joinedload, object_session
 
 # -------------------- Load .env --------------------
 BASE_DIR = Path(__file__).resolve().parent
@@ -63,6 +63,31 @@ else:
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['UPLOAD_FOLDER'] = str(UPLOAD_FOLDER)
 
+# Компилираните шаблони се пазят на диска между рестартите
+JINJA_CACHE_DIR = INSTANCE_DIR / 'jinja_cache'
+os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(str(JINJA_CACHE_DIR))
+if DATABASE_URL:
+    # в production шаблоните не се променят - без проверка за промени при всяко зареждане
+    app.config['TEMPLATES_AUTO_RELOAD'] = False
+    app.jinja_env.auto_reload = False
+
+@lru_cache(maxsize=4096)
+def _cached_url_for(script_root, endpoint, values):
+    return url_for(endpoint, **dict(values))
+
+def cached_url_for(endpoint, **values):
+    """url_for за шаблоните: резултатът се кешира по endpoint и аргументи."""
+    if not has_request_context() or values.get('_external'):
+        return url_for(endpoint, **values)
+    try:
+        return _cached_url_for(request.script_root, endpoint, tuple(sorted(values.items())))
+    except TypeError:
+        # нехеширащи се аргументи (напр. списъци) - без кеш
+        return url_for(endpoint, **values)
+
+app.jinja_env.globals['url_for'] = cached_url_for
+
 # In-memory mapping (can be populated by CSV import or bot binds)
 phone_to_telegram = {}
 
@@ -73,38 +98,75 @@ SMTP_PORT = int(os.environ.get('SMTP_PORT', '0')) if os.environ.get('SMTP_PORT')
 SMTP_USER = os.environ.get('SMTP_USER', '')
 SMTP_PASS = os.environ.get('SMTP_PASS', '')
 
+# Обща HTTP сесия за Telegram API (keep-alive, без нов TLS handshake за всяко съобщение)
+_HTTP = requests.Session()
+_HTTP.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=32))
+
 # -------------------- Logging --------------------
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger('trenera')
 
 # -------------------- Extensions --------------------
+if app.config['SQLALCHEMY_DATABASE_URI'].startswith('postgresql'):
+    # пул за нишките на gunicorn + планировчика; pre_ping/recycle срещу прекъснати връзки
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE') or '10'),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW') or '20'),
+        'pool_pre_ping': True,
+        'pool_recycle': 1800,
+    }
 db = SQLAlchemy(app)
+
+if app.config['SQLALCHEMY_DATABASE_URI'].startswith('sqlite:///'):
+    # WAL: четенията не чакат записите; по-малко fsync при synchronous=NORMAL
+    def _sqlite_pragmas(dbapi_conn, _record):
+        cur = dbapi_conn.cursor()
+        cur.execute('PRAGMA journal_mode=WAL')
+        cur.execute('PRAGMA synchronous=NORMAL')
+        cur.execute('PRAGMA temp_store=MEMORY')
+        cur.execute('PRAGMA mmap_size=268435456')
+        cur.close()
+
+    with app.app_context():
+        event.listen(db.engine, 'connect', _sqlite_pragmas)
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 
 # -------------------- Telegram webhook (simple) --------------------
 import json
 
+# компилира се веднъж при импорт, вместо при всяко извикване
+_NON_DIGIT_RE = re.compile(r'\D')
+# изтрива всички ASCII символи без цифрите; str.translate работи на C ниво и е по-бърз от regex
+_ASCII_NON_DIGITS = str.maketrans('', '', ''.join(chr(c) for c in range(128) if not chr(c).isdigit()))
+
+def _digits_only(s: str) -> str:
+    digits = s.translate(_ASCII_NON_DIGITS)
+    if not digits.isascii():
+        # не-ASCII символи (напр. кирилица) остават след translate
+        digits = _NON_DIGIT_RE.sub('', digits)
+    return digits
+
 def normalize_phone_for_match(ph):
     """Връща последните 9 цифри (за сравнение на бг номера)."""
     if not ph:
         return None
-    digits = re.sub(r'\D', '', str(ph))
+    digits = _digits_only(str(ph))
     # keep last 9 digits (e.g. 888123456)
     return digits[-9:] if len(digits) >= 9 else digits
 
-def send_telegram(chat_id, text):
-    """Изпраща съобщение към Telegram bot API (проста реализация)."""
-    if not TELEGRAM_BOT_TOKEN or not chat_id:
-        logger.info("send_telegram - липсва token или chat_id")
-        return
-    try:
-        requests.post(
-            f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage",
-            json={"chat_id": str(chat_id), "text": text, "disable_web_page_preview": True}
-        )
-    except Exception:
-        logger.exception("send_telegram failed")
+def normalize_webhook_phone(phone_str):
+    """Нормализира телефон от Telegram съобщение към формат 359XXXXXXXXX."""
+    if not phone_str:
+        return None
+    digits = _digits_only(phone_str)
+    if digits.startswith('0') and len(digits) == 10:
+        return '359' + digits[1:]
+    elif digits.startswith('359') and len(digits) == 11:
+        return digits
+    elif digits.startswith('00359') and len(digits) == 12:
+        return digits[2:]
+    return digits[-9:]  # fallback
 
 @app.route(f"/webhook/{TELEGRAM_BOT_TOKEN}", methods=["POST"])
 def telegram_webhook():
@@ -118,7 +180,7 @@ def telegram_webhook():
 
         # Handle /start command
         if text.lower() in ("/start", "старт"):
-            send_telegram(
+            queue_telegram(
                 chat_id,
                 "Добре дошли в системата Trenera! 📲\n"
                 "Моля, въведете вашия телефонен номер (пример: 0888123456), за да активирате известия."
@@ -126,63 +188,43 @@ def telegram_webhook():
             return "OK", 200
 
         # Normalize phone number
-        def normalize_phone(phone_str):
-            if not phone_str:
-                return None
-            digits = re.sub(r'\D', '', phone_str)
-            if digits.startswith('0') and len(digits) == 10:
-                return '359' + digits[1:]
-            elif digits.startswith('359') and len(digits) == 11:
-                return digits
-            elif digits.startswith('00359') and len(digits) == 12:
-                return digits[2:]
-            return digits[-9:]  # fallback
-
-        phone_number = normalize_phone(text)
+        phone_number = normalize_webhook_phone(text)
         logger.info(f"[TELEGRAM] Normalized phone: {phone_number} from input: {text}")
 
         if not phone_number or len(phone_number) < 9:
-            send_telegram(chat_id, "❌ Невалиден формат на телефон. Пример: 0888123456")
+            queue_telegram(chat_id, "❌ Невалиден формат на телефон. Пример: 0888123456")
             return "OK", 200
 
-        # Search for player by parent_phone or player_phone
-        players = Player.query.all()
-        matched_players = []
+        # Search for player by parent_phone or player_phone (по последните 9 цифри)
+        suffix = phone_number[-9:]
+        matched_players = find_players_by_phone9(suffix)
 
-        for player in players:
-            parent_normalized = normalize_phone(player.parent_phone)
-            player_normalized = normalize_phone(player.player_phone)
-
-            # DEBUG LOG
-            logger.info(
-                f"[MATCH DEBUG] Player {player.id} {player.full_name} "
-                f"parent_phone={player.parent_phone} -> norm={parent_normalized} "
-                f"player_phone={player.player_phone} -> norm={player_normalized} "
-                f"input_norm={phone_number}"
-            )
-
-            if (parent_normalized and parent_normalized.endswith(phone_number[-9:])) or \
-               (player_normalized and player_normalized.endswith(phone_number[-9:])):
-                matched_players.append(player)
+        if logger.isEnabledFor(logging.DEBUG):
+            for player in matched_players:
+                logger.debug(
+                    "[MATCH DEBUG] Player %s %s parent_phone=%s -> norm=%s player_phone=%s -> norm=%s input_norm=%s",
+                    player.id, player.full_name, player.parent_phone, player.parent_phone_norm,
+                    player.player_phone, player.player_phone_norm, phone_number,
+                )
 
         if matched_players:
             logger.info(f"[DB] Found {len(matched_players)} matching players")
 
-            for player in matched_players:
-                logger.info(f"[DB] Updating player {player.id} {player.full_name}")
-                logger.info(f"[DB] Old telegram_id: {player.parent_telegram_id}")
-                player.parent_telegram_id = chat_id
-                db.session.add(player)
+            if logger.isEnabledFor(logging.DEBUG):
+                for player in matched_players:
+                    logger.debug("[DB] Updating player %s %s, old telegram_id: %s",
+                                 player.id, player.full_name, player.parent_telegram_id)
 
             try:
+                # един UPDATE за всички съвпадения вместо запис по запис
+                ids = [player.id for player in matched_players]
+                updated = Player.query.filter(Player.id.in_(ids)).update(
+                    {Player.parent_telegram_id: chat_id}, synchronize_session=False
+                )
                 db.session.commit()
-                logger.info("[DB] Commit executed")
-
-                for player in matched_players:
-                    check = Player.query.get(player.id)
-                    logger.info(f"[DB CHECK] After commit -> player {check.id} telegram_id={check.parent_telegram_id}")
+                logger.info(f"[DB] Commit executed, updated {updated} players")
 
-                send_telegram(
+                queue_telegram(
                     chat_id,
                     f"✅ Вашият номер беше регистриран успешно за {len(matched_players)} състезател(и).\n\n"
                     "Отсега нататък ще получавате известия за:\n"
@@ -191,11 +233,12 @@ def telegram_webhook():
                     "• ⏰ Напомняния за плащане"
                 )
             except Exception as e:
+                db.session.rollback()
                 logger.error(f"[DB] Failed to commit changes: {str(e)}")
-                send_telegram(chat_id, "❌ Възникна грешка при регистрацията. Моля, опитайте отново.")
+                queue_telegram(chat_id, "❌ Възникна грешка при регистрацията. Моля, опитайте отново.")
         else:
-            logger.warning(f"[DB] No player found with phone ending with: {phone_number[-9:]}")
-            send_telegram(
+            logger.warning(f"[DB] No player found with phone ending with: {suffix}")
+            queue_telegram(
                 chat_id,
                 "❌ Този номер не е намерен в системата.\n"
                 "Моля, свържете се с треньора, за да ви добави."
@@ -212,7 +255,15 @@ def maybe_set_webhook():
         host = os.environ.get('RENDER_EXTERNAL_HOSTNAME') or os.environ.get('EXTERNAL_HOSTNAME')
         if TELEGRAM_BOT_TOKEN and host:
             url = f"https://{host}/webhook/{TELEGRAM_BOT_TOKEN}"
-            r = requests.post(f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/setWebhook", json={"url": url}, timeout=10)
+            payload = {
+                "url": url,
+                # колко паралелни заявки да праща Telegram към нас (по подразбиране 40)
+                "max_connections": int(os.environ.get('TG_MAX_CONN', '40')),
+                # ботът обработва само текстови съобщения (/start + телефон)
+                "allowed_updates": ["message"],
+                "drop_pending_updates": os.environ.get('TG_DROP_PENDING') == '1',
+            }
+            r = _HTTP.post(f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/setWebhook", json=payload, timeout=10)
             if r.ok:
                 logger.info("Telegram webhook set -> %s", url)
             else:
@@ -235,6 +286,34 @@ class User(UserMixin, db.Model):
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
 
+# -------------------- Cache invalidation --------------------
+# Кешовете в паметта се изчистват след commit, а не при flush: иначе паралелна заявка
+# между flush и commit би кеширала още непотвърдените данни за целия TTL.
+_PENDING_INVALIDATIONS = 'pending_cache_invalidations'
+
+def invalidate_on_commit(session, fn):
+    """Отбелязва fn за извикване след успешен commit на session."""
+    session.info.setdefault(_PENDING_INVALIDATIONS, set()).add(fn)
+
+def invalidate_after_commit(fn, *models):
+    """fn се вика след commit на сесия, в която е записан/изтрит обект от models."""
+    def _mark(mapper, connection, target):
+        session = object_session(target)
+        if session is not None:
+            invalidate_on_commit(session, fn)
+    for model in models:
+        for evt in ('after_insert', 'after_update', 'after_delete'):
+            event.listen(model, evt, _mark)
+
+@event.listens_for(db.session, 'after_commit')
+def _run_pending_invalidations(session):
+    for fn in session.info.pop(_PENDING_INVALIDATIONS, ()):
+        fn()
+
+@event.listens_for(db.session, 'after_rollback')
+def _drop_pending_invalidations(session):
+    session.info.pop(_PENDING_INVALIDATIONS, None)
+
 class Team(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(120), nullable=False)
@@ -242,21 +321,100 @@ class Team(db.Model):
     gender = db.Column(db.String(10), nullable=True)  # boys/girls
     players = db.relationship('Player', backref='team', lazy=True)
 
+# Списъкът с отбори (за падащи менюта и филтри) се чете рядко променян - пазим го в паметта.
+# Редовете са прости (id, name, age_group, gender), за да не зависят от сесията.
+# Другите процеси на gunicorn виждат промяната най-късно след _TEAMS_TTL секунди.
+_TEAMS_TTL = 60
+_teams_cache = None  # (loaded_at, rows)
+
+def invalidate_teams_cache(*_args):
+    global _teams_cache
+    _teams_cache = None
+
+invalidate_after_commit(invalidate_teams_cache, Team)
+
+def cached_teams():
+    """Всички отбори, подредени по име."""
+    global _teams_cache
+    cached = _teams_cache
+    if cached and time.monotonic() - cached[0] < _TEAMS_TTL:
+        return cached[1]
+    rows = db.session.query(Team.id, Team.name, Team.age_group, Team.gender).order_by(Team.name).all()
+    _teams_cache = (time.monotonic(), rows)
+    return rows
+
 class Player(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    full_name = db.Column(db.String(200), nullable=False)
+    full_name = db.Column(db.String(200), nullable=False, index=True)
     birth_date = db.Column(db.Date, nullable=True)
     player_phone = db.Column(db.String(50), nullable=True)
     parent_phone = db.Column(db.String(50), nullable=True)
     parent_telegram_id = db.Column(db.String(80), nullable=True)
     email = db.Column(db.String(120), nullable=True)
     notes = db.Column(db.String(400), nullable=True)
-    team_id = db.Column(db.Integer, db.ForeignKey('team.id'), nullable=True)
+    team_id = db.Column(db.Integer, db.ForeignKey('team.id'), nullable=True, index=True)
+    # последните 9 цифри на телефоните (попълват се автоматично при запис)
+    parent_phone_norm = db.Column(db.String(9), nullable=True, index=True)
+    player_phone_norm = db.Column(db.String(9), nullable=True, index=True)
 
     payments = db.relationship('Payment', backref='player', lazy=True, cascade='all, delete-orphan')
     attendances = db.relationship('Attendance', backref='player', lazy=True)
 
+@event.listens_for(Player, 'before_insert')
+def _fill_player_phone_norm(mapper, connection, target):
+    target.parent_phone_norm = normalize_phone_for_match(target.parent_phone)
+    target.player_phone_norm = normalize_phone_for_match(target.player_phone)
+
+@event.listens_for(Player, 'before_update')
+def _refresh_player_phone_norm(mapper, connection, target):
+    # преизчисляваме само ако телефонът е променен (напр. не при смяна на telegram_id)
+    state = inspect(target)
+    if state.attrs.parent_phone.history.has_changes():
+        target.parent_phone_norm = normalize_phone_for_match(target.parent_phone)
+    if state.attrs.player_phone.history.has_changes():
+        target.player_phone_norm = normalize_phone_for_match(target.player_phone)
+
+# -------------------- Phone lookup --------------------
+# само колоните, нужни при търсене по телефон - без пълни ORM обекти
+_PHONE9_COLUMNS = (Player.id, Player.full_name, Player.parent_phone, Player.player_phone,
+                   Player.parent_phone_norm, Player.player_phone_norm, Player.parent_telegram_id)
+
+def find_players_by_phone9(suffix):
+    """Връща редове (id, full_name, телефони, parent_telegram_id) на играчите,
+    чийто телефон (на родител или на играч) завършва на suffix (9 цифри)."""
+    # нормализираните колони са индексирани - директна заявка, без кеш в паметта
+    return db.session.query(*_PHONE9_COLUMNS).filter(
+        db.or_(Player.parent_phone_norm == suffix, Player.player_phone_norm == suffix)
+    ).all()
+
+# -------------------- Player choices cache --------------------
+# Падащото меню с играчи при добавяне на плащане - само (id, full_name).
+# Другите процеси на gunicorn виждат промяната най-късно след _PLAYER_CHOICES_TTL секунди.
+_PLAYER_CHOICES_TTL = 60
+_player_choices_cache = None  # (loaded_at, rows)
+
+def invalidate_player_choices(*_args):
+    global _player_choices_cache
+    _player_choices_cache = None
+
+invalidate_after_commit(invalidate_player_choices, Player)
+
+def cached_player_choices():
+    """(id, full_name) на всички играчи, подредени по име."""
+    global _player_choices_cache
+    cached = _player_choices_cache
+    if cached and time.monotonic() - cached[0] < _PLAYER_CHOICES_TTL:
+        return cached[1]
+    rows = db.session.query(Player.id, Player.full_name).order_by(Player.full_name).all()
+    _player_choices_cache = (time.monotonic(), rows)
+    return rows
+
 class Payment(db.Model):
+    __table_args__ = (
+        db.Index('ix_payment_ym_status', 'year', 'month', 'status'),
+        # търсене на плащане за конкретен играч и месец; не е unique, защото в старите данни има дубликати
+        db.Index('ix_payment_player_ym', 'player_id', 'year', 'month'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     player_id = db.Column(db.Integer, db.ForeignKey('player.id'), nullable=False)
     year = db.Column(db.Integer, nullable=False)
@@ -267,6 +425,12 @@ class Payment(db.Model):
     note = db.Column(db.String(255), nullable=True)
 
 class TrainingSession(db.Model):
+    __table_args__ = (
+        # филтърът по месец (+ отбор) в trainings() и календара
+        db.Index('ix_ts_date_team', 'date', 'team_id'),
+        # ключът за дубликати при материализиране на слотове и графиците по отбор
+        db.Index('ix_session_team_date_start', 'team_id', 'date', 'start_time'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     team_id = db.Column(db.Integer, db.ForeignKey('team.id'), nullable=True)
     date = db.Column(db.Date, nullable=False)
@@ -274,8 +438,13 @@ class TrainingSession(db.Model):
     end_time = db.Column(db.String(20), nullable=True)    # optional "19:30"
     notes = db.Column(db.String(400), nullable=True)
     attendances = db.relationship('Attendance', backref='session', lazy=True, cascade='all, delete-orphan')
+    team = db.relationship('Team')
 
 class Attendance(db.Model):
+    __table_args__ = (
+        # по един запис на играч за занимание (ключ за upsert-а в attendance())
+        db.Index('ux_att_session_player', 'session_id', 'player_id', unique=True),
+    )
     id = db.Column(db.Integer, primary_key=True)
     session_id = db.Column(db.Integer, db.ForeignKey('training_session.id'), nullable=False)
     player_id = db.Column(db.Integer, db.ForeignKey('player.id'), nullable=False)
@@ -333,7 +502,7 @@ class TrainingPlan(db.Model):
 # -------------------- Auth & Roles --------------------
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return db.session.get(User, int(user_id))
 
 # Цветова схема и нормализация на имената на отбори (консистентна навсякъде)
 TEAM_COLORS = {
@@ -344,26 +513,27 @@ TEAM_COLORS = {
     'Старша': '#6f42c1',  # лилаво (ако се ползва)
 }
 
+# ключови нормализации по кирилица/латиница (един regex вместо поредица от str.replace)
+_TEAM_LABEL_REPL = {
+    'u12': 'u-12',
+    'u 12': 'u-12',
+    'u18': 'u-18',
+    'u 18': 'u-18',
+    'girls': 'ж',
+    'boys': 'м',
+    'момичета': 'ж',
+    'момчета': 'м',
+    'мъже': 'м',
+}
+_TEAM_LABEL_RE = re.compile('|'.join(map(re.escape, sorted(_TEAM_LABEL_REPL, key=len, reverse=True))))
+
+@lru_cache(maxsize=512)
 def _normalize_team_label(raw: str) -> str:
     """Мапва различни варианти към точните етикети от графика."""
     if not raw:
         return ''
     n = (raw or '').strip().lower()
-    # ключови нормализации по кирилица/латиница
-    repl = (
-        ('u12', 'u-12'),
-        ('u 12', 'u-12'),
-        ('u18', 'u-18'),
-        ('u 18', 'u-18'),
-        ('girls', 'ж'),
-        ('girls', 'ж'),
-        ('boys', 'м'),
-        ('момичета', 'ж'),
-        ('момчета', 'м'),
-        ('мъже', 'м'),
-    )
-    for a, b in repl:
-        n = n.replace(a, b)
+    n = _TEAM_LABEL_RE.sub(lambda m: _TEAM_LABEL_REPL[m.group(0)], n)
     n = n.replace('  ', ' ')
     # точни разпознавания
     if 'u-12' in n and 'ж' in n:
@@ -382,10 +552,21 @@ def _normalize_team_label(raw: str) -> str:
         return cap
     return cap
 
+@lru_cache(maxsize=512)
 def team_color_for_name(name: str) -> str:
     key = _normalize_team_label(name)
     return TEAM_COLORS.get(key, '#0d6efd')
 
+_VENUE_RE = re.compile('НУПИ|ЧАВДАР|СТАДИОН', re.IGNORECASE)
+
+@lru_cache(maxsize=256)
+def guess_venue(notes: str) -> str:
+    """Залата от бележките на тренировката (първата спомената) или ''."""
+    if not notes:
+        return ''
+    m = _VENUE_RE.search(notes)
+    return m.group(0).upper() if m else ''
+
 # направи модела Team достъпен в Jinja шаблоните като 'Team' и функцията team_color
 @app.context_processor
 def inject_models():
@@ -427,6 +608,9 @@ def send_email(to_email, subject, body):
         logger.info(f"No email provided; stub send: {subject}")
         return False
     if SMTP_HOST and SMTP_PORT and SMTP_USER and SMTP_PASS:
+        # импортират се само при реално изпращане
+        import smtplib
+        from email.message import EmailMessage
         try:
             msg = EmailMessage()
             msg['From'] = SMTP_USER
@@ -453,7 +637,7 @@ def send_telegram(chat_id, message):
     if TELEGRAM_BOT_TOKEN:
         try:
             url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
-            resp = requests.post(url, json={"chat_id": str(chat_id), "text": message})
+            resp = _HTTP.post(url, json={"chat_id": str(chat_id), "text": message, "disable_web_page_preview": True}, timeout=5)
             if resp.ok:
                 logger.info(f"Telegram sent to {chat_id}")
                 return True
@@ -467,6 +651,76 @@ def send_telegram(chat_id, message):
         logger.info(f"(Stub) Telegram to {chat_id}: {message}")
         return True
 
+# Telegram съобщенията от webhook-а се изпращат от фонова нишка, за да не чака
+# заявката мрежовия отговор. Спазват се лимитите на Bot API: ~30 съобщения/сек
+# общо и ~1 съобщение/сек към един чат.
+_TG_GLOBAL_INTERVAL = 1 / 30
+_TG_CHAT_INTERVAL = 1.0
+_tg_queue = queue.Queue()
+_tg_worker = None
+_tg_worker_lock = threading.Lock()
+
+def _telegram_worker():
+    # чакащите съобщения са по чат (в реда на подаване); в heap-а е всеки чат с чакащи
+    # съобщения и моментът, от който може да получи следващото. Чат, който още е в
+    # своя 1 сек интервал, не задържа останалите - чака се само глобалният лимит.
+    pending = {}  # chat_id -> deque(text)
+    ready = []    # heap от (ready_at, seq, chat_id)
+    last_sent = 0.0
+    last_by_chat = {}
+    seq = 0
+    while True:
+        now = time.monotonic()
+        if ready:
+            timeout = max(ready[0][0], last_sent + _TG_GLOBAL_INTERVAL) - now
+        else:
+            timeout = None
+        if timeout is None or timeout > 0:
+            try:
+                chat_id, text = _tg_queue.get(timeout=timeout)
+            except queue.Empty:
+                continue
+            _tg_queue.task_done()
+            if chat_id in pending:
+                pending[chat_id].append(text)
+            else:
+                pending[chat_id] = deque([text])
+                seq += 1
+                heapq.heappush(ready, (max(now, last_by_chat.get(chat_id, 0.0) + _TG_CHAT_INTERVAL), seq, chat_id))
+            continue
+        _, _, chat_id = heapq.heappop(ready)
+        texts = pending[chat_id]
+        try:
+            send_telegram(chat_id, texts.popleft())
+        except Exception:
+            logger.exception('Telegram worker failed')
+        last_sent = time.monotonic()
+        last_by_chat[chat_id] = last_sent
+        if texts:
+            seq += 1
+            heapq.heappush(ready, (last_sent + _TG_CHAT_INTERVAL, seq, chat_id))
+        else:
+            del pending[chat_id]
+        if len(last_by_chat) > 1000:
+            last_by_chat = {k: t for k, t in last_by_chat.items() if last_sent - t < _TG_CHAT_INTERVAL}
+
+def queue_telegram(chat_id, text):
+    """Слага съобщението в опашката за изпращане и връща веднага."""
+    global _tg_worker
+    if _tg_worker is None or not _tg_worker.is_alive():
+        with _tg_worker_lock:
+            if _tg_worker is None or not _tg_worker.is_alive():
+                _tg_worker = threading.Thread(target=_telegram_worker, name='telegram-sender', daemon=True)
+                _tg_worker.start()
+    _tg_queue.put((chat_id, text))
+
+# Имейлите от заявките се изпращат от малък пул нишки - SMTP връзката е бавна.
+_email_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='email-sender')
+
+def queue_email(to_email, subject, body):
+    """Подава имейла за изпращане във фонов режим и връща веднага."""
+    _email_executor.submit(send_email, to_email, subject, body)
+
 def resolve_telegram_id_by_phone(phone):
     if not phone:
         return None
@@ -474,282 +728,14 @@ def resolve_telegram_id_by_phone(phone):
     t = phone_to_telegram.get(normalized)
     if t:
         return t
-    p = Player.query.filter_by(parent_phone=normalized).first()
-    if p and p.parent_telegram_id:
-        return p.parent_telegram_id
+    suffix = normalize_phone_for_match(normalized)
+    if not suffix:
+        return None
+    for p in find_players_by_phone9(suffix):
+        if p.parent_phone_norm == suffix and p.parent_telegram_id:
+            return p.parent_telegram_id
     return None
 
-# -------------------- Template creation --------------------
-BASIC_TEMPLATES = {}
-
-# Minimal templates (we'll add others if missing)
-BASIC_TEMPLATES['base.html'] = """<!doctype html>
-<html lang="bg">
-<head>
-  <meta charset="utf-8">
-  <meta name="viewport" content="width=device-width, initial-scale=1">
-  <title>Trenera</title>
-  <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/css/bootstrap.min.css" rel="stylesheet">
-</head>
-<body>
-<nav class="navbar navbar-expand-lg navbar-light bg-light mb-4">
-  <div class="container-fluid">
-    <a class="navbar-brand" href="{{ url_for('index') }}">🔹 Trenera</a>
-    <div class="collapse navbar-collapse">
-      <ul class="navbar-nav me-auto mb-2 mb-lg-0">
-        {% if current_user.is_authenticated %}
-          <li class="nav-item"><a class="nav-link" href="{{ url_for('players') }}">Играчите</a></li>
-          <li class="nav-item"><a class="nav-link" href="{{ url_for('payments') }}">Плащания</a></li>
-          <li class="nav-item"><a class="nav-link" href="{{ url_for('teams') }}">Отбори</a></li>
-          <li class="nav-item"><a class="nav-link" href="{{ url_for('trainings') }}">Тренировки</a></li>
-          {% if current_user.role == 'admin' %}<li class="nav-item"><a class="nav-link" href="{{ url_for('admin_panel') }}">Админ</a></li>{% endif %}
-        {% endif %}
-      </ul>
-    </div>
-    <div class="d-flex">
-      {% if current_user.is_authenticated %}
-        <span class="me-2">{{ current_user.username }} ({{ current_user.role }})</span>
-        <a class="btn btn-outline-secondary btn-sm me-2" href="{{ url_for('logout') }}">Изход</a>
-      {% else %}
-        <a class="btn btn-outline-primary btn-sm" href="{{ url_for('login') }}">Вход</a>
-      {% endif %}
-    </div>
-  </div>
-</nav>
-<div class="container">
-  {% with messages = get_flashed_messages(with_categories=true) %}
-    {% if messages %}
-      {% for cat, msg in messages %}
-        <div class="alert alert-{{ 'success' if cat=='success' else 'danger' }} alert-dismissible fade show" role="alert">
-          {{ msg }}
-          <button type="button" class="btn-close" data-bs-dismiss="alert" aria-label="Close"></button>
-        </div>
-      {% endfor %}
-    {% endif %}
-  {% endwith %}
-  {% block content %}{% endblock %}
-</div>
-<script src="https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/js/bootstrap.bundle.min.js"></script>
-</body>
-</html>"""
-
-BASIC_TEMPLATES['login.html'] = """{% extends 'base.html' %}{% block content %}<div class="row justify-content-center"><div class="col-md-5"><h3 class="mb-3">🔐 Вход</h3><form method="post"><div class="mb-3"><label>Потребителско име</label><input class="form-control" name="username" required></div><div class="mb-3"><label>Парола</label><input class="form-control" name="password" type="password" required></div><button class="btn btn-primary">Вход</button></form></div></div>{% endblock %}"""
-
-# players, player_form, payments, teams, trainings, attendance, stats, admin templates
-BASIC_TEMPLATES['index.html'] = """{% extends 'base.html' %}{% block content %}<h2>Добре дошли</h2><p>Изберете действие.</p>{% endblock %}"""
-
-BASIC_TEMPLATES['players.html'] = """{% extends 'base.html' %}{% block content %}
-<div class="d-flex justify-content-between align-items-center mb-3">
-  <h3>Играчите</h3>
-  <a class="btn btn-success" href="{{ url_for('add_player') }}">➕ Добави</a>
-</div>
-<form class="row g-2 mb-3" method="get">
-  <div class="col-auto">
-    <input name="q" class="form-control" placeholder="Търси по име..." value="{{ request.args.get('q','') }}">
-  </div>
-  <div class="col-auto">
-    <select name="team_id" class="form-select" onchange="this.form.submit()">
-      <option value="">Всички отбори</option>
-      {% for t in Team.query.order_by(Team.name).all() %}
-        <option value="{{ t.id }}" {% if request.args.get('team_id') and request.args.get('team_id')|int==t.id %}selected{% endif %}>{{ t.name }}</option>
-      {% endfor %}
-    </select>
-  </div>
-  <div class="col-auto">
-    <button class="btn btn-outline-secondary">Филтър</button>
-  </div>
-</form>
-<div class="row">
-{% for p in players %}
-  <div class="col-12 col-md-6 col-lg-4">
-    <div class="card mb-3">
-      <div class="card-body">
-        <h5 class="card-title">{{ p.full_name }}</h5>
-        <p class="mb-1"><strong>Отбор:</strong> {{ p.team.name if p.team else '—' }}</p>
-        <p class="mb-1"><strong>Родител:</strong> {{ p.parent_phone or '—' }}</p>
-        <p class="mb-1"><strong>Email:</strong> {{ p.email or '—' }}</p>
-        <div class="mt-2">
-          <a class="btn btn-sm btn-primary" href="{{ url_for('edit_player', player_id=p.id) }}">✏ Редактирай</a>
-          <a class="btn btn-sm btn-outline-secondary" href="{{ url_for('player_payments', player_id=p.id) }}">💳 Плащания</a>
-          <a class="btn btn-sm btn-warning" href="{{ url_for('remind_player', player_id=p.id) }}">🔔 Напомни</a>
-        </div>
-      </div>
-    </div>
-  </div>
-{% endfor %}
-</div>
-{% endblock %}"""
-
-BASIC_TEMPLATES['player_form.html'] = """{% extends 'base.html' %}{% block content %}
-<h3>{{ 'Редактирай' if player else 'Нов състезател' }}</h3>
-<form method="post" class="row g-2">
-  <div class="col-12"><label>Име</label><input name="full_name" class="form-control" value="{{ player.full_name if player else '' }}" required></div>
-  <div class="col-6"><label>Дата ражд.</label><input name="birth_date" type="date" class="form-control" value="{{ player.birth_date if player and player.birth_date else '' }}"></div>
-  <div class="col-6"><label>Отбор</label><select name="team_id" class="form-select"><option value=''>-- без отбор --</option>{% for t in teams %}<option value='{{ t.id }}' {% if player and player.team_id==t.id %}selected{% endif %}>{{ t.name }}</option>{% endfor %}</select></div>
-  <div class="col-6"><label>Тел. съст.</label><input name="player_phone" class="form-control" value="{{ player.player_phone if player else '' }}"></div>
-  <div class="col-6"><label>Тел. родител</label><input name="parent_phone" class="form-control" value="{{ player.parent_phone if player else '' }}"></div>
-  <div class="col-6"><label>Email</label><input name="email" class="form-control" value="{{ player.email if player else '' }}"></div>
-  <div class="col-6"><label>Telegram ID</label><input name="parent_telegram_id" class="form-control" value="{{ player.parent_telegram_id if player else '' }}"></div>
-  <div class="col-12"><label>Бележки</label><textarea name="notes" class="form-control">{{ player.notes if player else '' }}</textarea></div>
-  <div class="col-12"><button class="btn btn-primary">Запази</button></div>
-</form>
-{% endblock %}"""
-
-BASIC_TEMPLATES['payments.html'] = """{% extends 'base.html' %}{% block content %}
-<h3>Плащания</h3>
-<form class="row g-2 mb-3" method="get">
-  <div class="col-auto"><input name="search" class="form-control" placeholder="Търси" value="{{ request.args.get('search','') }}"></div>
-  <div class="col-auto"><input name="year" class="form-control" placeholder="Година" value="{{ request.args.get('year','') }}"></div>
-  <div class="col-auto"><input name="month" class="form-control" placeholder="Месец" value="{{ request.args.get('month','') }}"></div>
-  <div class="col-auto"><button class="btn btn-outline-primary">Филтрирай</button></div>
-</form>
-<div class="mb-3 text-end">
-  <form method="post" action="{{ url_for('remind_all_payments') }}" class="d-inline">
-    <button class="btn btn-warning">🔔 Напомни на всички неплатили</button>
-  </form>
-</div>
-<table class="table table-striped">
-  <thead><tr><th>Играч</th><th>Година</th><th>Месец</th><th>Сума</th><th>Статус</th><th>Действие</th></tr></thead>
-  <tbody>
-    {% for pay in payments %}
-    <tr>
-      <td>{{ pay.player.full_name }}</td><td>{{ pay.year }}</td><td>{{ pay.month }}</td><td>{{ pay.amount }} лв.</td>
-      <td>{% if pay.status=='paid' %}<span class="badge bg-success">Платено</span>{% else %}<span class="badge bg-danger">Неплатено</span>{% endif %}</td>
-      <td>
-        {% if pay.status != 'paid' %}
-          <div class="btn-group">
-            <button class="btn btn-sm btn-success dropdown-toggle" data-bs-toggle="dropdown">Плати</button>
-            <ul class="dropdown-menu">
-              {% for m in range(1,13) %}<li><a class="dropdown-item" href="{{ url_for('mark_paid', payment_id=pay.id) }}?month={{ m }}&year={{ pay.year }}">Месец {{ m }}</a></li>{% endfor %}
-            </ul>
-          </div>
-          <form method="post" action="{{ url_for('remind_payment', payment_id=pay.id) }}" style="display:inline"><button class="btn btn-sm btn-outline-warning">🔔</button></form>
-        {% endif %}
-      </td>
-    </tr>
-    {% endfor %}
-  </tbody>
-</table>
-{% endblock %}"""
-
-BASIC_TEMPLATES['teams.html'] = """{% extends 'base.html' %}{% block content %}
-<div class="d-flex justify-content-between align-items-center mb-3">
-  <h3>Отбори</h3>
-  {% if current_user.role=='admin' %}<a class="btn btn-success" href="{{ url_for('add_team') }}">➕ Добави</a>{% endif %}
-</div>
-<table class="table">
-  <thead><tr><th>Име</th><th>Възраст</th><th>Пол</th><th>Играч(и)</th><th></th></tr></thead>
-  <tbody>
-    {% for t in teams %}
-    <tr>
-      <td>{{ t.name }}</td><td>{{ t.age_group or '-' }}</td><td>{{ t.gender or '-' }}</td><td>{{ t.players|length }}</td>
-      <td>
-        {% if current_user.role=='admin' %}
-          <a class="btn btn-sm btn-primary" href="{{ url_for('edit_team', team_id=t.id) }}">✏</a>
-          <form method="post" action="{{ url_for('delete_team', team_id=t.id) }}" style="display:inline" onsubmit="return confirm('Сигурни ли сте?')">
-            <button class="btn btn-sm btn-danger">Изтрий</button>
-          </form>
-        {% endif %}
-      </td>
-    </tr>
-    {% endfor %}
-  </tbody>
-</table>
-{% endblock %}"""
-
-BASIC_TEMPLATES['trainings.html'] = """{% extends 'base.html' %}{% block content %}
-<div class="d-flex justify-content-between align-items-center mb-3">
-  <h3>Тренировки</h3>
-  <a class="btn btn-success" href="{{ url_for('add_training') }}">➕ Добави тренировка</a>
-</div>
-<table class="table">
-  <thead><tr><th>Дата</th><th>Отбор</th><th>Час</th><th>Бележки</th><th>Присъствие</th></tr></thead>
-  <tbody>
-    {% for tr in trainings %}
-    <tr>
-      <td>{{ tr.date.strftime('%d.%m.%Y') }}</td>
-      <td>{{ tr.session_team.name if tr.session_team else '—' }}</td>
-      <td>{{ tr.start_time or '-' }} - {{ tr.end_time or '-' }}</td>
-      <td>{{ tr.notes or '' }}</td>
-      <td><a class="btn btn-sm btn-primary" href="{{ url_for('attendance_form', training_id=tr.id) }}">Отбележи</a></td>
-    </tr>
-    {% endfor %}
-  </tbody>
-</table>
-{% endblock %}"""
-
-BASIC_TEMPLATES['training_form.html'] = """{% extends 'base.html' %}{% block content %}
-<h3>Добави/Редактирай тренировка</h3>
-<form method="post" class="row g-2">
-  <div class="col-6"><label>Дата</label><input name="date" type="date" class="form-control" required value="{{ training.date if training else '' }}"></div>
-  <div class="col-6"><label>Отбор</label><select name="team_id" class="form-select">{% for t in teams %}<option value="{{ t.id }}" {% if training and training.team_id==t.id %}selected{% endif %}>{{ t.name }}</option>{% endfor %}</select></div>
-  <div class="col-6"><label>Начален час</label><input name="start_time" class="form-control" placeholder="18:00" value="{{ training.start_time if training else '' }}"></div>
-  <div class="col-6"><label>Краен час</label><input name="end_time" class="form-control" placeholder="19:30" value="{{ training.end_time if training else '' }}"></div>
-  <div class="col-12"><label>Бележки</label><textarea name="notes" class="form-control">{{ training.notes if training else '' }}</textarea></div>
-  <div class="col-12"><button class="btn btn-primary">Запази</button></div>
-</form>
-{% endblock %}"""
-
-BASIC_TEMPLATES['attendance_form.html'] = """{% extends 'base.html' %}{% block content %}
-<h3>Присъствие за {{ training.date.strftime('%d.%m.%Y') }} — {{ training.session_team.name if training.session_team else '' }}</h3>
-<form method="post">
-  <table class="table">
-    <thead><tr><th>Играч</th><th>Присъства</th></tr></thead>
-    <tbody>
-      {% for p in players %}
-      <tr>
-        <td>{{ p.full_name }}</td>
-        <td><input type="checkbox" name="present_{{ p.id }}" {% if attendance_map.get(p.id) == 'present' %}checked{% endif %}></td>
-      </tr>
-      {% endfor %}
-    </tbody>
-  </table>
-  <div class="mb-3"><label>Бележка до родител (по избор)</label><input name="note" class="form-control"></div>
-  <div class="mb-3">
-    <button class="btn btn-primary">Запази присъствие</button>
-    <button type="submit" name="notify" value="1" class="btn btn-warning">Запази и Изпрати уведомления</button>
-  </div>
-</form>
-{% endblock %}"""
-
-BASIC_TEMPLATES['attendance_stats.html'] = """{% extends 'base.html' %}{% block content %}
-<h3>Статистика присъствия</h3>
-<h5>Играч: {{ player.full_name }}</h5>
-<p>Общо тренировки: {{ total }}, Присъствия: {{ present }}, Процент: {{ percent }}%</p>
-<hr>
-<h5>Отбор: {{ team.name if team else '-' }}</h5>
-<table class="table">
-  <thead><tr><th>Играч</th><th>Общо</th><th>Присъства</th><th>%</th></tr></thead>
-  <tbody>
-    {% for r in rows %}
-    <tr><td>{{ r.full_name }}</td><td>{{ r.total }}</td><td>{{ r.present }}</td><td>{{ r.percent }}</td></tr>
-    {% endfor %}
-  </tbody>
-</table>
-{% endblock %}"""
-
-BASIC_TEMPLATES['admin.html'] = """{% extends 'base.html' %}{% block content %}
-<h3>Админ</h3>
-<div class="mb-3"><a class="btn btn-primary" href="{{ url_for('create_user') }}">Добави потребител</a></div>
-<div class="card mb-3"><div class="card-body">
-<h5>Импорт на състезатели (.csv)</h5>
-<form method="post" action="{{ url_for('admin_import') }}" enctype="multipart/form-data">
-  <input type="file" name="file" accept=".csv" required class="form-control mb-2">
-  <button class="btn btn-success">Качи и импортирай</button>
-</form>
-<small>Колони: Състезател,Отбор,Дата на раждане,Телефон на състезател,Телефон на родителя,Имейл</small>
-</div></div>
-<table class="table"><thead><tr><th>Потребител</th><th>Роля</th></tr></thead><tbody>{% for u in users %}<tr><td>{{ u.username }}</td><td>{{ u.role }}</td></tr>{% endfor %}</tbody></table>
-{% endblock %}"""
-
-# Write templates if missing
-def ensure_templates():
-    for name, content in BASIC_TEMPLATES.items():
-        path = TEMPLATES_DIR / name
-        if not path.exists():
-            path.write_text(content, encoding='utf-8')
-            logger.info(f'Created template {name}')
-
 # -------------------- Helpers for notifications --------------------
 def notify_attendance_change(player, training, status, note=None):
     # status: 'present' or 'absent'
@@ -761,7 +747,7 @@ def notify_attendance_change(player, training, status, note=None):
     if note:
         message += f'\n📝 Бележка: {note}'
     # send only telegram for attendance notifications
-    send_telegram(player.parent_telegram_id, message)
+    queue_telegram(player.parent_telegram_id, message)
 
 # -------------------- Broadcast messages (Telegram) --------------------
 @app.route('/broadcast', methods=['GET', 'POST'])
@@ -771,7 +757,7 @@ def broadcast():
     if getattr(current_user, 'role', None) not in ('trainer', 'admin'):
         abort(403)
 
-    all_teams = Team.query.order_by(Team.name).all()
+    all_teams = cached_teams()
 
     # Шаблони по подразбиране; могат да се редактират в текстовото поле
     templates = [
@@ -861,8 +847,14 @@ def logout():
 @app.route('/teams')
 @login_required
 def teams():
-    teams = Team.query.order_by(Team.name).all()
-    return render_template('teams.html', teams=teams)
+    # броят играчи се смята в SQL, без да се зареждат всички Player записи
+    rows = db.session.query(Team, db.func.count(Player.id)) \
+        .outerjoin(Player, Player.team_id == Team.id) \
+        .group_by(Team.id) \
+        .order_by(Team.name).all()
+    teams = [t for t, _ in rows]
+    player_counts = {t.id: cnt for t, cnt in rows}
+    return render_template('teams.html', teams=teams, player_counts=player_counts)
 
 @app.route('/teams/add', methods=['GET','POST'])
 @role_required('admin')
@@ -884,7 +876,7 @@ def add_team():
 @app.route('/teams/<int:team_id>/edit', methods=['GET','POST'])
 @role_required('admin')
 def edit_team(team_id):
-    t = Team.query.get_or_404(team_id)
+    t = db.get_or_404(Team, team_id)
     if request.method == 'POST':
         t.name = request.form.get('name'); t.age_group = request.form.get('age_group'); t.gender = request.form.get('gender')
         db.session.commit(); flash('Отборът е обновен', 'success'); return redirect(url_for('teams'))
@@ -893,7 +885,7 @@ def edit_team(team_id):
 @app.route('/teams/<int:team_id>/delete', methods=['POST'])
 @role_required('admin')
 def delete_team(team_id):
-    t = Team.query.get_or_404(team_id)
+    t = db.get_or_404(Team, team_id)
     for p in t.players:
         p.team_id = None
     db.session.delete(t); db.session.commit()
@@ -903,7 +895,7 @@ def delete_team(team_id):
 @app.route('/players/<int:player_id>/delete', methods=['POST'])
 @role_required('trainer')
 def delete_player(player_id):
-    player = Player.query.get_or_404(player_id)
+    player = db.get_or_404(Player, player_id)
 
     # Изтриваме свързаните плащания и присъствия, за да няма осиротели записи
     Payment.query.filter_by(player_id=player.id).delete()
@@ -922,9 +914,11 @@ def delete_player(player_id):
 def players():
     q = request.args.get('q', '').strip()
     team_id = request.args.get('team_id')
-    query = Player.query
+    query = Player.query.options(joinedload(Player.team))
     if q:
-        query = query.filter(Player.full_name.ilike(f'%{q}%'))
+        # % и _ от търсенето се търсят буквално; на Postgres ILIKE ползва trigram индекса
+        pattern = q.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        query = query.filter(Player.full_name.ilike(f'%{pattern}%', escape='\\'))
     if team_id and team_id.isdigit():
         query = query.filter_by(team_id=int(team_id))
     players = query.order_by(Player.full_name).all()
@@ -952,13 +946,13 @@ def add_player():
                 p.birth_date = None
         db.session.add(p); db.session.commit()
         flash('Играчът е добавен', 'success'); return redirect(url_for('players'))
-    teams = Team.query.order_by(Team.name).all()
+    teams = cached_teams()
     return render_template('player_form.html', player=None, teams=teams)
 
 @app.route('/players/<int:player_id>/edit', methods=['GET','POST'])
 @role_required('trainer')
 def edit_player(player_id):
-    player = Player.query.get_or_404(player_id)
+    player = db.get_or_404(Player, player_id)
     if request.method == 'POST':
         player.full_name = request.form['full_name']
         bd = request.form.get('birth_date')
@@ -974,7 +968,7 @@ def edit_player(player_id):
         player.team_id = request.form.get('team_id') or None
         player.notes = request.form.get('notes')
         db.session.commit(); flash('Играчът е обновен', 'success'); return redirect(url_for('players'))
-    teams = Team.query.order_by(Team.name).all()
+    teams = cached_teams()
     return render_template('player_form.html', player=player, teams=teams)
 
 
@@ -986,21 +980,25 @@ def edit_player(player_id):
 def payments_list():
     from datetime import datetime
 
-    month = request.args.get('month', type=int) or datetime.now().month
-    year = request.args.get('year', type=int) or datetime.now().year
+    now = datetime.now()
+    month = request.args.get('month', type=int) or now.month
+    year = request.args.get('year', type=int) or now.year
+    # просрочие има само за текущия месец след 5-то число
+    overdue_window = month == now.month and year == now.year and now.day > 5
 
     players = Player.query.order_by(Player.full_name).all()
     data = []
     new_payments = []
 
-    print(f"[DEBUG] Намерени {len(players)} състезатели")
+    logger.debug("Намерени %d състезатели", len(players))
+
+    # всички плащания за месеца с една заявка вместо по една за всеки състезател
+    pay_map = {}
+    for pay in Payment.query.filter_by(month=month, year=year).order_by(Payment.id).all():
+        pay_map.setdefault(pay.player_id, pay)
 
     for p in players:
-        pay = Payment.query.filter_by(
-            player_id=p.id,
-            month=month,
-            year=year
-        ).first()
+        pay = pay_map.get(p.id)
 
         # Ако няма плащане за този месец/година → създаваме го
         if not pay:
@@ -1011,24 +1009,19 @@ def payments_list():
                 amount=0,
                 status='pending'
             )
-            db.session.add(pay)
             new_payments.append(pay)
 
         data.append({
             'player': p,
             'payment': pay,
-            'overdue': (
-                pay.status == 'pending'
-                and datetime.now().day > 5
-                and month == datetime.now().month
-                and year == datetime.now().year
-            )
+            'overdue': overdue_window and pay.status == 'pending'
         })
 
     # Записваме новите плащания, ако има такива
     if new_payments:
+        db.session.add_all(new_payments)
         db.session.commit()
-        print(f"[DEBUG] Добавени нови плащания: {len(new_payments)}")
+        logger.debug("Добавени нови плащания: %d", len(new_payments))
 
     return render_template(
         'payments.html',
@@ -1042,7 +1035,7 @@ def payments_list():
 @login_required
 @role_required('trainer')
 def mark_payment_paid(payment_id):
-    payment = Payment.query.get_or_404(payment_id)
+    payment = db.get_or_404(Payment, payment_id)
     payment.mark_paid()
     db.session.commit()
 
@@ -1052,9 +1045,9 @@ def mark_payment_paid(payment_id):
     msg = f"✅ Плащането за {date_str} е отбелязано като получено."
 
     if player.email:
-        send_email(player.email, "Потвърждение за плащане", msg)
+        queue_email(player.email, "Потвърждение за плащане", msg)
     if player.parent_telegram_id:
-        send_telegram(player.parent_telegram_id, msg)
+        queue_telegram(player.parent_telegram_id, msg)
 
     flash(f"Плащането за {player.full_name} е маркирано като получено.", "success")
     return redirect(url_for('payments', year=payment.year, month=payment.month))
@@ -1063,38 +1056,95 @@ def mark_payment_paid(payment_id):
 @app.route('/players/<int:player_id>/remind', methods=['GET'])
 @login_required
 def remind_player(player_id):
-    player = Player.query.get_or_404(player_id)
+    player = db.get_or_404(Player, player_id)
 
     msg = f"Напомняне: Здравейте, родител на {player.full_name}, имате съобщение от треньора."
     
     # Изпращане по имейл
-    send_email(player.email, "Напомняне от треньора", msg)
+    queue_email(player.email, "Напомняне от треньора", msg)
 
     # Изпращане по телеграм
-    send_telegram(player.parent_telegram_id, msg)
+    queue_telegram(player.parent_telegram_id, msg)
 
     flash(f"Изпратено напомняне на {player.full_name}", "success")
     return redirect(url_for('players'))
 
+def _present_player_ids(session_id):
+    """Множество от id-тата на присъствалите играчи (само колоната player_id)."""
+    return frozenset(pid for (pid,) in db.session.query(Attendance.player_id)
+                     .filter_by(session_id=session_id, status='present'))
+
+_attendance_unique_ready = False
+
+def _require_attendance_unique_index():
+    """ON CONFLICT изисква ux_att_session_player - без него ясна грешка вместо SQL грешка."""
+    global _attendance_unique_ready
+    if _attendance_unique_ready:
+        return
+    if 'ux_att_session_player' not in {ix['name'] for ix in inspect(db.engine).get_indexes('attendance')}:
+        raise RuntimeError('Има дублирани присъствия и уникалният индекс липсва - '
+                           'изпълнете "flask --app app_v3 dedupe-attendance".')
+    _attendance_unique_ready = True
+
+def _upsert_attendance(session_id, statuses):
+    """Записва {player_id: status} за занимание с INSERT ... ON CONFLICT DO UPDATE
+    (променят се само редовете с различен статус); без commit."""
+    dialect = db.engine.dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        _require_attendance_unique_index()
+    # записи на играчи, които вече не са в отбора, се махат както преди
+    Attendance.query.filter(
+        Attendance.session_id == session_id, Attendance.player_id.notin_(list(statuses))
+    ).delete(synchronize_session=False)
+    if not statuses:
+        return
+    if dialect not in ('postgresql', 'sqlite'):
+        Attendance.query.filter_by(session_id=session_id).delete(synchronize_session=False)
+        db.session.bulk_save_objects([
+            Attendance(session_id=session_id, player_id=pid, status=status) for pid, status in statuses.items()
+        ])
+        return
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    stmt = insert(Attendance.__table__).values([
+        {'session_id': session_id, 'player_id': pid, 'status': status} for pid, status in statuses.items()
+    ])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['session_id', 'player_id'],
+        set_={'status': stmt.excluded.status},
+        where=Attendance.__table__.c.status != stmt.excluded.status,
+    )
+    db.session.execute(stmt)
+
 @app.route('/attendance/<int:training_id>', methods=['GET', 'POST'])
 @login_required
 @role_required('trainer')
 def attendance(training_id):
-    training = TrainingSession.query.get_or_404(training_id)
+    training = db.get_or_404(TrainingSession, training_id)
     players = Player.query.filter_by(team_id=training.team_id).all()
 
     if request.method == 'POST':
-        # изтриваме старите записи за това занимание
-        Attendance.query.filter_by(session_id=training.id).delete()
+        statuses = {
+            player.id: 'present' if request.form.get(f'attendance_{player.id}') else 'absent'
+            for player in players
+        }
+        # всички записи в една транзакция
+        try:
+            _upsert_attendance(training.id, statuses)
+        except RuntimeError as e:
+            db.session.rollback()
+            logger.error(str(e))
+            flash(str(e), 'error')
+            return redirect(url_for('attendance', training_id=training.id))
+        db.session.commit()
+        invalidate_stats_cache()  # bulk записът не минава през ORM събитията
 
+        # Уведомяване на родителите
+        date_str = training.date.strftime('%d.%m.%Y')
         for player in players:
-            status = 'present' if request.form.get(f'attendance_{player.id}') else 'absent'
-            new_att = Attendance(session_id=training.id, player_id=player.id, status=status)
-            db.session.add(new_att)
-            db.session.commit()
-
-            # Уведомяване на родителите
-            date_str = training.date.strftime('%d.%m.%Y')
+            status = statuses[player.id]
             if status == 'present':
                 msg = f"✅ {player.full_name} присъства на тренировка на {date_str}."
             else:
@@ -1102,29 +1152,25 @@ def attendance(training_id):
 
             # Email
             if player.email:
-                send_email(player.email, "Известие за присъствие", msg)
+                queue_email(player.email, "Известие за присъствие", msg)
 
             # Telegram
             if player.parent_telegram_id:
-                send_telegram(player.parent_telegram_id, msg)
+                queue_telegram(player.parent_telegram_id, msg)
 
         flash("Присъствията са записани и родителите са уведомени.", "success")
         return redirect(url_for('trainings'))
 
     # Съществуващи присъствия за предварително маркиране
-    attendance_map = {
-        a.player_id: a.status
-        for a in Attendance.query.filter_by(session_id=training.id).all()
-    }
-
-    return render_template('attendance.html', training=training, players=players, attendance=attendance_map)
+    return render_template('attendance.html', training=training, players=players,
+                           present_ids=_present_player_ids(training.id))
 
 
 @app.route('/payments/<int:payment_id>/remind')
 @login_required
 @role_required('trainer')
 def remind_payment(payment_id):
-    payment = Payment.query.get_or_404(payment_id)
+    payment = db.get_or_404(Payment, payment_id)
     player = payment.player
 
     # Съобщение за родителите
@@ -1132,11 +1178,11 @@ def remind_payment(payment_id):
 
     # Изпращане на имейл
     if player.email:
-        send_email(player.email, "Напомняне за плащане", message)
+        queue_email(player.email, "Напомняне за плащане", message)
 
     # Изпращане на телеграм
     if player.parent_telegram_id:
-        send_telegram(player.parent_telegram_id, message)
+        queue_telegram(player.parent_telegram_id, message)
 
     flash(f'Изпратено е напомняне за {player.full_name} 🔔', 'success')
     return redirect(url_for('payments_list'))
@@ -1145,15 +1191,20 @@ def remind_payment(payment_id):
 @login_required
 @role_required('trainer')
 def remind_all_payments():
-    payments = Payment.query.all()
-    for payment in payments:
-        player = payment.player
-        message = f"Напомняне: Таксата за {payment.month}/{payment.year} за {player.full_name}."
-        
-        if player.email:
-            send_email(player.email, "Напомняне за плащане", message)
-        if player.parent_telegram_id:
-            send_telegram(player.parent_telegram_id, message)
+    # само неплатените такси на играчи с контакт; една заявка с JOIN, четена на порции
+    rows = db.session.query(
+        Payment.month, Payment.year, Player.full_name, Player.email, Player.parent_telegram_id
+    ).join(Player, Payment.player_id == Player.id).filter(
+        Payment.status != 'paid',
+        db.or_(Player.email.isnot(None), Player.parent_telegram_id.isnot(None))
+    ).yield_per(500)
+    for month, year, full_name, email, telegram_id in rows:
+        message = f"Напомняне: Таксата за {month}/{year} за {full_name}."
+
+        if email:
+            queue_email(email, "Напомняне за плащане", message)
+        if telegram_id:
+            queue_telegram(telegram_id, message)
 
     flash("Изпратени са напомняния на всички 📨", "success")
     return redirect(url_for('payments_list'))
@@ -1162,6 +1213,32 @@ def remind_all_payments():
 @login_required
 @role_required('trainer')
 def stats_page():
+    return render_template("stats.html", **_stats_data())
+
+# Агрегатите за /stats се пазят до _STATS_TTL секунди или до промяна на плащане/присъствие
+# (другите процеси на gunicorn виждат промяната най-късно след TTL).
+_STATS_TTL = 300
+_stats_cache = None  # (loaded_at, data)
+
+def invalidate_stats_cache(*_args):
+    global _stats_cache
+    _stats_cache = None
+
+invalidate_after_commit(invalidate_stats_cache, Payment, Attendance)
+
+@event.listens_for(db.session, 'do_orm_execute')
+def _invalidate_stats_on_bulk_write(state):
+    # query.update()/query.delete() не викат mapper събитията
+    if (state.is_update or state.is_delete) and state.bind_mapper is not None \
+            and state.bind_mapper.class_ in (Payment, Attendance):
+        invalidate_on_commit(state.session, invalidate_stats_cache)
+
+def _stats_data():
+    global _stats_cache
+    cached = _stats_cache
+    if cached and time.monotonic() - cached[0] < _STATS_TTL:
+        return cached[1]
+
     # --- Плащания ---
     payments_stats = db.session.query(
         Payment.month,
@@ -1171,10 +1248,6 @@ def stats_page():
         db.func.sum(case((Payment.status != 'paid', 1), else_=0)).label("unpaid")
     ).group_by(Payment.year, Payment.month).order_by(Payment.year, Payment.month).all()
 
-    payments_labels = [f"{p.month:02d}/{p.year}" for p in payments_stats]
-    payments_paid = [p.paid for p in payments_stats]
-    payments_unpaid = [p.unpaid for p in payments_stats]
-
     # --- Присъствия ---
     attendance_stats = db.session.query(
         extract('month', TrainingSession.date).label("month"),
@@ -1184,22 +1257,30 @@ def stats_page():
      .group_by("year", "month") \
      .order_by("year", "month").all()
 
-    attendance_labels = [f"{int(row.month):02d}/{int(row.year)}" for row in attendance_stats]
-    attendance_percent = [round(row.attendance_percent * 100, 1) if row.attendance_percent else 0 for row in attendance_stats]
-
-    return render_template(
-        "stats.html",
-        payments_labels=payments_labels,
-        payments_paid=payments_paid,
-        payments_unpaid=payments_unpaid,
-        attendance_labels=attendance_labels,
-        attendance_percent=attendance_percent
+    data = dict(
+        payments_labels=[f"{p.month:02d}/{p.year}" for p in payments_stats],
+        payments_paid=[p.paid for p in payments_stats],
+        payments_unpaid=[p.unpaid for p in payments_stats],
+        attendance_labels=[f"{int(row.month):02d}/{int(row.year)}" for row in attendance_stats],
+        attendance_percent=[round(row.attendance_percent * 100, 1) if row.attendance_percent else 0 for row in attendance_stats],
     )
+    _stats_cache = (time.monotonic(), data)
+    return data
 
 import csv
-from io import StringIO
+from io import StringIO, TextIOWrapper
 from flask import Response
 
+def _csv_stream(rows):
+    """Генерира CSV ред по ред, без да държи целия файл в паметта."""
+    buf = StringIO()
+    writer = csv.writer(buf)
+    for row in rows:
+        writer.writerow(row)
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate(0)
+
 @app.route('/stats/payments_csv')
 @login_required
 @role_required('trainer')
@@ -1209,36 +1290,29 @@ def stats_payments_csv():
         Payment.year, Payment.month
     ).distinct().order_by(Payment.year, Payment.month).all()
 
-    # Взимаме всички състезатели
-    players = Player.query.order_by(Player.full_name).all()
+    # Взимаме всички състезатели (само нужните колони)
+    players = db.session.query(Player.id, Player.full_name).order_by(Player.full_name).all()
 
-    # Подготвяме данни: {player_id: { (year, month): amount }}
+    # Подготвяме данни с една заявка: {(player_id, year, month): amount}
+    # първото плащане по id за периода решава, както при .first()
     payments_map = {}
-    for p in players:
-        payments_map[p.id] = {}
-        for year, month in periods:
-            pay = Payment.query.filter_by(player_id=p.id, year=year, month=month).first()
-            payments_map[p.id][(year, month)] = float(pay.amount) if (pay and pay.status == 'paid') else 0.0
+    for pid, year, month, amount, status in db.session.query(
+        Payment.player_id, Payment.year, Payment.month, Payment.amount, Payment.status
+    ).order_by(Payment.id):
+        payments_map.setdefault((pid, year, month), float(amount) if status == 'paid' else 0.0)
 
-    # Генерираме CSV
-    output = StringIO()
-    writer = csv.writer(output)
+    # Генерираме CSV ред по ред, без да държим целия файл в паметта
+    def generate():
+        # Заглавен ред
+        yield ["Състезател"] + [f"{month:02d}.{year}" for year, month in periods]
 
-    # Заглавен ред
-    header = ["Състезател"] + [f"{month:02d}.{year}" for year, month in periods]
-    writer.writerow(header)
-
-    # Редове за състезатели
-    for p in players:
-        row = [p.full_name]
-        for year, month in periods:
-            row.append(payments_map[p.id][(year, month)])
-        writer.writerow(row)
+        # Редове за състезатели
+        for pid, full_name in players:
+            yield [full_name] + [payments_map.get((pid, year, month), 0.0) for year, month in periods]
 
     # Връщаме като отговор за сваляне
-    output.seek(0)
     return Response(
-        output.getvalue(),
+        _csv_stream(generate()),
         mimetype="text/csv",
         headers={"Content-Disposition": "attachment; filename=payments_stats.csv"}
     )
@@ -1280,30 +1354,38 @@ def admin_coaches():
         if User.query.filter_by(username=username).first():
             flash('Потребител вече съществува','error')
             return redirect(url_for('admin_coaches'))
-        u = User(username=username, role='trainer')
-        u.set_password(password)
-        db.session.add(u); db.session.commit()
-        cp = CoachProfile(user_id=u.id, full_name=full_name, phone=phone,
-                          can_manage_players=bool(request.form.get('can_manage_players')),
-                          can_manage_payments=bool(request.form.get('can_manage_payments')),
-                          can_mark_attendance=bool(request.form.get('can_mark_attendance')),
-                          can_manage_slots=bool(request.form.get('can_manage_slots')),
-                          can_manage_tournaments=bool(request.form.get('can_manage_tournaments')),
-                          can_manage_inventory=bool(request.form.get('can_manage_inventory')))
-        db.session.add(cp); db.session.commit()
-        for tid in team_ids:
-            if tid.isdigit():
-                db.session.add(CoachTeam(coach_id=cp.id, team_id=int(tid)))
-        db.session.commit()
+        # всичко в една транзакция; flush() дава id-тата без commit
+        try:
+            u = User(username=username, role='trainer')
+            u.set_password(password)
+            db.session.add(u); db.session.flush()
+            cp = CoachProfile(user_id=u.id, full_name=full_name, phone=phone,
+                              can_manage_players=bool(request.form.get('can_manage_players')),
+                              can_manage_payments=bool(request.form.get('can_manage_payments')),
+                              can_mark_attendance=bool(request.form.get('can_mark_attendance')),
+                              can_manage_slots=bool(request.form.get('can_manage_slots')),
+                              can_manage_tournaments=bool(request.form.get('can_manage_tournaments')),
+                              can_manage_inventory=bool(request.form.get('can_manage_inventory')))
+            db.session.add(cp); db.session.flush()
+            db.session.add_all([CoachTeam(coach_id=cp.id, team_id=int(tid)) for tid in team_ids if tid.isdigit()])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            logger.exception('Failed to create coach')
+            flash('Грешка при създаване на треньора','error')
+            return redirect(url_for('admin_coaches'))
         flash('Треньорът е създаден','success')
         return redirect(url_for('admin_coaches'))
     coaches = CoachProfile.query.all()
-    coach_rows = []
-    for c in coaches:
-        user = User.query.get(c.user_id)
-        teams = [Team.query.get(ct.team_id).name for ct in CoachTeam.query.filter_by(coach_id=c.id).all() if Team.query.get(ct.team_id)]
-        coach_rows.append({'coach': c, 'user': user, 'teams': teams})
-    teams = Team.query.order_by(Team.name).all()
+    teams = cached_teams()
+    # по една заявка за потребители и връзки вместо по няколко за всеки треньор
+    users = {u.id: u for u in User.query.filter(User.id.in_([c.user_id for c in coaches])).all()}
+    team_names = {t.id: t.name for t in teams}
+    coach_teams = {}
+    for ct in CoachTeam.query.order_by(CoachTeam.id).all():
+        if ct.team_id in team_names:
+            coach_teams.setdefault(ct.coach_id, []).append(team_names[ct.team_id])
+    coach_rows = [{'coach': c, 'user': users.get(c.user_id), 'teams': coach_teams.get(c.id, [])} for c in coaches]
     return render_template('coaches.html', coach_rows=coach_rows, teams=teams)
 
 @app.route('/admin/coaches/<int:coach_id>/teams', methods=['POST'])
@@ -1326,16 +1408,23 @@ def seed_default_coaches():
         if not u:
             u = User(username=username, role='trainer')
             u.set_password(password)
-            db.session.add(u); db.session.commit()
+            db.session.add(u); db.session.flush()
         cp = CoachProfile.query.filter_by(user_id=u.id).first()
         if not cp:
             cp = CoachProfile(user_id=u.id, full_name=full_name, can_manage_players=True,
                               can_manage_payments=True, can_mark_attendance=True,
                               can_manage_slots=False, can_manage_tournaments=True,
                               can_manage_inventory=True)
-            db.session.add(cp); db.session.commit()
-    ensure('anatoli', 'anatoli9010', 'Anatoli')
-    ensure('pepi', 'pepi2025', 'Pepi')
+            db.session.add(cp)
+    try:
+        ensure('anatoli', 'anatoli9010', 'Anatoli')
+        ensure('pepi', 'pepi2025', 'Pepi')
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        logger.exception('Failed to seed coaches')
+        flash('Грешка при създаване на треньорите','error')
+        return redirect(url_for('admin_coaches'))
     flash('Треньорите Anatoli и Pepi са налични/обновени','success')
     return redirect(url_for('admin_coaches'))
 
@@ -1346,15 +1435,13 @@ def coach_schedule(coach_id):
     month = request.args.get('month', type=int) or date.today().month
     year = request.args.get('year', type=int) or date.today().year
     team_ids = [ct.team_id for ct in CoachTeam.query.filter_by(coach_id=coach_id).all()]
-    q = TrainingSession.query 
+    q = TrainingSession.query.options(joinedload(TrainingSession.team))
     q = q.filter(extract('month', TrainingSession.date)==month,
                  extract('year', TrainingSession.date)==year)
     if team_ids:
         q = q.filter(TrainingSession.team_id.in_(team_ids))
     trainings = q.order_by(TrainingSession.date.asc(), TrainingSession.start_time.asc()).all()
-    for t in trainings:
-        t.session_team = Team.query.get(t.team_id) if t.team_id else None
-    return render_template('trainings.html', trainings=trainings, month=month, year=year, teams=Team.query.order_by(Team.name).all(), selected_team_id=None)
+    return render_template('trainings.html', trainings=trainings, month=month, year=year, teams=cached_teams(), selected_team_id=None)
 
 # ---------- Tournament management ----------
 class Tournament(db.Model):
@@ -1370,6 +1457,14 @@ class TournamentTeam(db.Model):
     tournament_id = db.Column(db.Integer, db.ForeignKey('tournament.id'), nullable=False)
     team_id = db.Column(db.Integer, db.ForeignKey('team.id'), nullable=False)
 
+def _tournament_team_names():
+    """{tournament_id: [имена на отбори]} с една заявка (JOIN към отборите)."""
+    names = {}
+    for tournament_id, name in db.session.query(TournamentTeam.tournament_id, Team.name) \
+            .join(Team, Team.id == TournamentTeam.team_id).order_by(TournamentTeam.id):
+        names.setdefault(tournament_id, []).append(name)
+    return names
+
 @app.route('/tournaments', methods=['GET','POST'])
 @login_required
 @coach_permission_required('can_manage_tournaments')
@@ -1382,19 +1477,22 @@ def tournaments():
             venue=request.form.get('venue'),
             notes=request.form.get('notes')
         )
-        db.session.add(t); db.session.commit()
-        for tid in request.form.getlist('team_ids'):
-            if tid.isdigit():
-                db.session.add(TournamentTeam(tournament_id=t.id, team_id=int(tid)))
-        db.session.commit()
+        try:
+            db.session.add(t); db.session.flush()
+            db.session.add_all([TournamentTeam(tournament_id=t.id, team_id=int(tid))
+                                for tid in request.form.getlist('team_ids') if tid.isdigit()])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            logger.exception('Failed to create tournament')
+            flash('Грешка при добавяне на турнира','error')
+            return redirect(url_for('tournaments'))
         flash('Турнирът е добавен','success')
         return redirect(url_for('tournaments'))
     items = Tournament.query.order_by(Tournament.start_date.desc().nullslast()).all()
-    teams = Team.query.order_by(Team.name).all()
-    rows = []
-    for t in items:
-        t_teams = [Team.query.get(x.team_id).name for x in TournamentTeam.query.filter_by(tournament_id=t.id).all() if Team.query.get(x.team_id)]
-        rows.append({'t': t, 'teams': t_teams})
+    teams = cached_teams()
+    names = _tournament_team_names()
+    rows = [{'t': t, 'teams': names.get(t.id, [])} for t in items]
     return render_template('tournaments.html', tournaments=rows, teams=teams)
 
 @app.route('/tournaments/<int:t_id>/delete', methods=['POST'])
@@ -1413,8 +1511,9 @@ def delete_tournament(t_id):
 def export_tournaments_excel():
     items = Tournament.query.order_by(Tournament.start_date.asc().nullslast(), Tournament.end_date.asc().nullslast(), Tournament.name.asc()).all()
     rows = []
+    names = _tournament_team_names()
     for t in items:
-        team_names = [Team.query.get(x.team_id).name for x in TournamentTeam.query.filter_by(tournament_id=t.id).all() if Team.query.get(x.team_id)]
+        team_names = names.get(t.id, [])
         start = t.start_date.strftime('%d.%m.%Y') if t.start_date else ''
         end = t.end_date.strftime('%d.%m.%Y') if t.end_date else ''
         date_str = f"{start} - {end}" if start and end else (start or end or '')
@@ -1483,7 +1582,7 @@ def inventory_delete(item_id):
 @login_required
 @coach_permission_required('can_manage_inventory')
 def inventory_adjust(item_id):
-    item = InventoryItem.query.get_or_404(item_id)
+    item = db.get_or_404(InventoryItem, item_id)
     delta = request.form.get('delta', type=int)
     item.quantity = max(0, (item.quantity or 0) + (delta or 0))
     db.session.commit()
@@ -1494,6 +1593,31 @@ def allowed_file(filename):
     ext = filename.rsplit('.',1)[-1].lower()
     return ext in ALLOWED_EXT
 
+_PLAYER_COPY_COLUMNS = ('id', 'full_name', 'birth_date', 'player_phone', 'player_phone_norm',
+                        'parent_phone', 'parent_phone_norm', 'email', 'team_id')
+
+def _copy_players(rows):
+    """Postgres: вмъква играчите с COPY ... FROM STDIN в текущата транзакция.
+    id-тата се взимат предварително от sequence-а и се записват в редовете."""
+    ids = db.session.execute(
+        text("SELECT nextval(pg_get_serial_sequence('player', 'id')) FROM generate_series(1, :n)"),
+        {'n': len(rows)}
+    ).scalars()
+    for r, pid in zip(rows, ids):
+        r['id'] = pid
+    buf = StringIO()
+    writer = csv.writer(buf)
+    for r in rows:
+        writer.writerow(['\\N' if r.get(c) is None else r[c] for c in _PLAYER_COPY_COLUMNS])
+    buf.seek(0)
+    cur = db.session.connection().connection.cursor()
+    try:
+        cur.copy_expert(
+            f"COPY player ({', '.join(_PLAYER_COPY_COLUMNS)}) FROM STDIN WITH (FORMAT csv, NULL '\\N')", buf
+        )
+    finally:
+        cur.close()
+
 @app.route('/admin/import', methods=['POST'])
 @role_required('admin')
 def admin_import():
@@ -1504,55 +1628,97 @@ def admin_import():
         flash('Няма избран файл','error'); return redirect(url_for('admin_panel'))
     if not allowed_file(f.filename):
         flash('Неразрешен тип (само CSV)','error'); return redirect(url_for('admin_panel'))
-    filename = secure_filename(f.filename); path = os.path.join(app.config['UPLOAD_FOLDER'], filename); f.save(path)
     try:
-        df = pd.read_csv(path)
+        # четем директно от качения поток - без запис във файл и повторно четене
+        fh = TextIOWrapper(f.stream, newline='', encoding='utf-8-sig')
+        reader = csv.reader(fh)
+        header = next(reader, [])
     except Exception:
         flash('Грешка при четене','error'); return redirect(url_for('admin_panel'))
-    col_map = {c.strip():c for c in df.columns}
-    required = ['Състезател','Отбор','Дата на раждане','Телефон на състезател','Телефон на родителя','Имейл']
-    missing = [r for r in required if r not in col_map]
-    if missing:
-        flash(f'Липсват колони: {", ".join(missing)}','error'); return redirect(url_for('admin_panel'))
-    created=0; updated=0
-    for _,row in df.iterrows():
-        full_name = str(row[col_map['Състезател']]).strip()
-        team_name = str(row[col_map['Отбор']]).strip()
-        dob_raw = row[col_map['Дата на раждане']]
-        player_phone = str(row[col_map['Телефон на състезател']]).strip()
-        parent_phone = str(row[col_map['Телефон на родителя']]).strip()
-        email = str(row[col_map['Имейл']]).strip()
-        dob=None
-        if pd.notna(dob_raw):
-            try:
-                if isinstance(dob_raw,str): dob = datetime.fromisoformat(dob_raw).date()
-                else: dob = pd.to_datetime(dob_raw).date()
-            except: dob=None
-        team=None
-        if team_name:
-            team = Team.query.filter_by(name=team_name).first()
-            if not team:
-                age_group=None; gender=None; low = team_name.lower()
-                for g in ['u12','u13','u14','u16','u18']:
-                    if g in low: age_group=g
-                if 'girl' in low or 'жен' in low or 'момич' in low: gender='girls'
-                if 'boy' in low or 'момч' in low or 'мъж' in low: gender='boys'
-                team = Team(name=team_name, age_group=age_group, gender=gender); db.session.add(team); db.session.commit()
-        existing=None
-        if parent_phone and parent_phone!='nan':
-            existing = Player.query.filter_by(full_name=full_name, parent_phone=parent_phone).first()
-        if not existing and player_phone and player_phone!='nan':
-            existing = Player.query.filter_by(full_name=full_name, player_phone=player_phone).first()
-        if existing:
-            existing.birth_date = dob or existing.birth_date
-            existing.player_phone = player_phone or existing.player_phone
-            existing.parent_phone = parent_phone or existing.parent_phone
-            existing.email = email or existing.email
-            existing.team_id = team.id if team else existing.team_id
-            db.session.commit(); updated+=1
-        else:
-            newp = Player(full_name=full_name, birth_date=dob, player_phone=player_phone, parent_phone=parent_phone, email=email, team_id=team.id if team else None)
-            db.session.add(newp); db.session.commit(); created+=1
+    with fh:
+        col_idx = {c.strip():i for i, c in enumerate(header)}
+        required = ['Състезател','Отбор','Дата на раждане','Телефон на състезател','Телефон на родителя','Имейл']
+        missing = [r for r in required if r not in col_idx]
+        if missing:
+            flash(f'Липсват колони: {", ".join(missing)}','error'); return redirect(url_for('admin_panel'))
+        # нужните колони се взимат наведнъж по индекс (без dict за всеки ред)
+        width = len(header); pick = itemgetter(*[col_idx[c] for c in required])
+        created=0; updated=0
+        # предварително зареждане на отбори и играчи - без заявка за всеки ред
+        team_ids = {name: tid for tid, name in db.session.query(Team.id, Team.name).order_by(Team.id.desc())}
+        by_parent = {}; by_player = {}
+        for r in db.session.query(Player.id, Player.full_name, Player.parent_phone, Player.player_phone).order_by(Player.id):
+            rec = {'id': r.id, 'full_name': r.full_name, 'parent_phone': r.parent_phone, 'player_phone': r.player_phone}
+            if r.parent_phone: by_parent.setdefault((r.full_name, r.parent_phone), rec)
+            if r.player_phone: by_player.setdefault((r.full_name, r.player_phone), rec)
+        new_rows = []; upd_rows = {}
+
+        def flush_chunk():
+            # bulk операциите не минават през ORM събитията, затова *_phone_norm се попълват тук;
+            # новите редове получават id, за да може по-късен ред от файла да ги обнови
+            if new_rows:
+                if db.engine.dialect.name == 'postgresql':
+                    _copy_players(new_rows)
+                else:
+                    db.session.bulk_insert_mappings(Player, new_rows, return_defaults=True)
+            if upd_rows:
+                db.session.bulk_update_mappings(Player, list(upd_rows.values()))
+            db.session.flush()
+            new_rows.clear(); upd_rows.clear()
+
+        try:
+            for i, row in enumerate(filter(None, reader), 1):  # празните редове се прескачат
+                if len(row) < width:
+                    row += [''] * (width - len(row))
+                full_name, team_name, dob_raw, player_phone, parent_phone, email = [v.strip() for v in pick(row)]
+                dob=None
+                if dob_raw:
+                    try: dob = datetime.fromisoformat(dob_raw).date()
+                    except ValueError: dob=None
+                team_id=None
+                if team_name:
+                    team_id = team_ids.get(team_name)
+                    if not team_id:
+                        age_group=None; gender=None; low = team_name.lower()
+                        for g in ['u12','u13','u14','u16','u18']:
+                            if g in low: age_group=g
+                        if 'girl' in low or 'жен' in low or 'момич' in low: gender='girls'
+                        if 'boy' in low or 'момч' in low or 'мъж' in low: gender='boys'
+                        team = Team(name=team_name, age_group=age_group, gender=gender); db.session.add(team); db.session.flush()
+                        team_id = team_ids[team_name] = team.id
+                existing=None
+                if parent_phone:
+                    existing = by_parent.get((full_name, parent_phone))
+                if not existing and player_phone:
+                    existing = by_player.get((full_name, player_phone))
+                if existing:
+                    changes = {}
+                    if dob: changes['birth_date'] = dob
+                    if player_phone: changes.update(player_phone=player_phone, player_phone_norm=normalize_phone_for_match(player_phone))
+                    if parent_phone: changes.update(parent_phone=parent_phone, parent_phone_norm=normalize_phone_for_match(parent_phone))
+                    if email: changes['email'] = email
+                    if team_id: changes['team_id'] = team_id
+                    existing.update(changes)
+                    if 'id' in existing:
+                        upd_rows.setdefault(existing['id'], {'id': existing['id']}).update(changes)
+                    updated+=1
+                else:
+                    existing = {'full_name': full_name, 'birth_date': dob,
+                                'player_phone': player_phone or None, 'player_phone_norm': normalize_phone_for_match(player_phone),
+                                'parent_phone': parent_phone or None, 'parent_phone_norm': normalize_phone_for_match(parent_phone),
+                                'email': email or None, 'team_id': team_id}
+                    new_rows.append(existing); created+=1
+                if parent_phone: by_parent.setdefault((full_name, parent_phone), existing)
+                if player_phone: by_player.setdefault((full_name, player_phone), existing)
+                # bulk запис на 1000 реда; целият файл е една транзакция
+                if i % 1000 == 0:
+                    flush_chunk()
+            flush_chunk()
+            db.session.commit()
+            invalidate_player_choices()
+        except (csv.Error, UnicodeDecodeError):
+            db.session.rollback()
+            flash('Грешка при четене - нищо не е импортирано','error'); return redirect(url_for('admin_panel'))
     flash(f'Импорт: добавени {created}, обновени {updated}','success'); return redirect(url_for('admin_panel'))
 
 # ---------- Trainings & Attendance ----------
@@ -1565,7 +1731,7 @@ def trainings():
     year = request.args.get('year', type=int) or today.year
     team_id = request.args.get('team_id', type=int)
 
-    q = TrainingSession.query
+    q = TrainingSession.query.options(joinedload(TrainingSession.team))
     # по месец/година
     q = q.filter(
         extract('month', TrainingSession.date) == month,
@@ -1575,11 +1741,8 @@ def trainings():
         q = q.filter(TrainingSession.team_id == team_id)
 
     trainings = q.order_by(TrainingSession.date.asc(), TrainingSession.start_time.asc()).all()
-    # attach team for display convenience
-    for t in trainings:
-        t.session_team = Team.query.get(t.team_id) if t.team_id else None
 
-    teams = Team.query.order_by(Team.name).all()
+    teams = cached_teams()
     return render_template('trainings.html', trainings=trainings, month=month, year=year, teams=teams, selected_team_id=team_id)
 
 @app.route('/trainings/add', methods=['GET', 'POST'])
@@ -1616,14 +1779,14 @@ def add_training():
             flash('Грешка при добавяне на тренировка: ' + str(e), 'error')
             return redirect(url_for('add_training'))
 
-    teams = Team.query.order_by(Team.name).all()
+    teams = cached_teams()
     return render_template('add_training.html', teams=teams)
 
 
 @app.route('/trainings/<int:training_id>/edit', methods=['GET','POST'])
 @role_required('trainer')
 def edit_training(training_id):
-    tr = TrainingSession.query.get_or_404(training_id)
+    tr = db.get_or_404(TrainingSession, training_id)
     if request.method == 'POST':
         tr.date = datetime.fromisoformat(request.form.get('date')).date()
         tr.team_id = int(request.form.get('team_id'))
@@ -1631,43 +1794,43 @@ def edit_training(training_id):
         tr.end_time = request.form.get('end_time')
         tr.notes = request.form.get('notes')
         db.session.commit(); flash('Тренировката е обновена','success'); return redirect(url_for('trainings'))
-    teams = Team.query.order_by(Team.name).all()
+    teams = cached_teams()
     return render_template('training_form.html', teams=teams, training=tr)
 
 @app.route('/trainings/<int:training_id>/delete', methods=['POST'])
 @role_required('trainer')
 def delete_training(training_id):
-    tr = TrainingSession.query.get_or_404(training_id)
+    tr = db.get_or_404(TrainingSession, training_id)
     db.session.delete(tr); db.session.commit(); flash('Тренировката е изтрита','success'); return redirect(url_for('trainings'))
 
 @app.route('/trainings/<int:training_id>/attendance', methods=['GET','POST'])
 @role_required('trainer')
 def attendance_form(training_id):
-    training = TrainingSession.query.get_or_404(training_id)
+    training = db.session.get(TrainingSession, training_id, options=[joinedload(TrainingSession.team)]) or abort(404)
     players = Player.query.filter_by(team_id=training.team_id).order_by(Player.full_name).all()
-    # map existing attendance
-    existing = Attendance.query.filter_by(session_id=training.id).all()
-    attendance_map = {a.player_id: a.status for a in existing}
     if request.method == 'POST':
         note = request.form.get('note','').strip()
         notify = request.form.get('notify') == '1'
-        # update/create attendance rows
+        # update/create attendance rows - existing rows loaded once, one commit at the end
+        existing = {a.player_id: a for a in Attendance.query.filter_by(session_id=training.id)}
+        now = datetime.now(timezone.utc)
         changed = []
+        new_rows = []
         for p in players:
             present_key = f'present_{p.id}'
             is_present = present_key in request.form
             new_status = 'present' if is_present else 'absent'
-            a = Attendance.query.filter_by(session_id=training.id, player_id=p.id).first()
+            a = existing.get(p.id)
             if a:
                 if a.status != new_status:
                     a.status = new_status
-                    a.noted_at = datetime.now(timezone.utc)
-                    db.session.commit()
+                    a.noted_at = now
                     changed.append((p, new_status))
             else:
-                a = Attendance(session_id=training.id, player_id=p.id, status=new_status, noted_at=datetime.now(timezone.utc))
-                db.session.add(a); db.session.commit()
+                new_rows.append(Attendance(session_id=training.id, player_id=p.id, status=new_status, noted_at=now))
                 changed.append((p, new_status))
+        db.session.add_all(new_rows)
+        db.session.commit()
         # if notify requested, send messages
         if notify:
             for p, st in changed:
@@ -1677,18 +1840,18 @@ def attendance_form(training_id):
                     logger.exception('Notify attendance failed for %s', p.id)
         flash('Присъствия записани' + (', уведомления изпратени' if notify else ''), 'success')
         return redirect(url_for('trainings'))
-    # add training_team for template
-    training.session_team = Team.query.get(training.team_id) if training.team_id else None
-    return render_template('attendance_form.html', training=training, players=players, attendance_map=attendance_map)
+    return render_template('attendance_form.html', training=training, players=players,
+                           present_ids=_present_player_ids(training.id))
 
 # ---------- Training Plans CRUD & Generation ----------
 @app.route('/plans')
 @login_required
 def plans_list():
     plans = TrainingPlan.query.order_by(TrainingPlan.team_id, TrainingPlan.weekday).all()
-    # attach team for display
+    # attach team for display (от кеширания списък, без заявка за всеки план)
+    teams_by_id = {t.id: t for t in cached_teams()}
     for p in plans:
-        p.plan_team = Team.query.get(p.team_id)
+        p.plan_team = teams_by_id.get(p.team_id)
     return render_template('plans.html', plans=plans)
 
 @app.route('/plans/add', methods=['GET', 'POST'])
@@ -1725,13 +1888,13 @@ def plan_add():
             flash('Грешка при добавяне на план: ' + str(e), 'error')
             return redirect(url_for('plan_add'))
 
-    teams = Team.query.order_by(Team.name).all()
+    teams = cached_teams()
     return render_template('plan_form.html', teams=teams, plan=None)
 
 @app.route('/plans/<int:plan_id>/edit', methods=['GET','POST'])
 @login_required
 def plan_edit(plan_id):
-    plan = TrainingPlan.query.get_or_404(plan_id)
+    plan = db.get_or_404(TrainingPlan, plan_id)
     if request.method == 'POST':
         plan.team_id = int(request.form.get('team_id'))
         plan.weekday = int(request.form.get('weekday'))
@@ -1745,13 +1908,13 @@ def plan_edit(plan_id):
         db.session.commit()
         flash('Планът е обновен','success')
         return redirect(url_for('plans_list'))
-    teams = Team.query.order_by(Team.name).all()
+    teams = cached_teams()
     return render_template('plan_form.html', teams=teams, plan=plan)
 
 @app.route('/plans/<int:plan_id>/delete', methods=['POST'])
 @login_required
 def plan_delete(plan_id):
-    plan = TrainingPlan.query.get_or_404(plan_id)
+    plan = db.get_or_404(TrainingPlan, plan_id)
     db.session.delete(plan)
     db.session.commit()
     flash('Планът е изтрит','success')
@@ -1766,9 +1929,9 @@ def daterange(start_date: date, end_date: date):
 @app.route('/plans/<int:plan_id>/generate', methods=['GET','POST'])
 @login_required
 def plan_generate(plan_id):
-    plan = TrainingPlan.query.get_or_404(plan_id)
+    plan = db.get_or_404(TrainingPlan, plan_id)
     # attach team for display
-    plan.plan_team = Team.query.get(plan.team_id)
+    plan.plan_team = db.session.get(Team, plan.team_id) if plan.team_id else None
     if request.method == 'POST':
         try:
             gen_start = datetime.fromisoformat(request.form.get('gen_start')).date()
@@ -1811,23 +1974,31 @@ def plan_generate(plan_id):
 @app.route('/attendance/stats/player/<int:player_id>')
 @login_required
 def attendance_stats_player(player_id):
-    player = Player.query.get_or_404(player_id)
-    total = Attendance.query.filter_by(player_id=player_id).count()
-    present = Attendance.query.filter_by(player_id=player_id, status='present').count()
+    player = db.get_or_404(Player, player_id)
+    total, present = db.session.query(
+        db.func.count(Attendance.id),
+        db.func.coalesce(db.func.sum(case((Attendance.status == 'present', 1), else_=0)), 0)
+    ).filter(Attendance.player_id == player_id).one()
     percent = round((present / total * 100) if total>0 else 0,1)
     return render_template('attendance_stats.html', player=player, total=total, present=present, percent=percent, team=None, rows=[])
 
 @app.route('/attendance/stats/team/<int:team_id>')
 @login_required
 def attendance_stats_team(team_id):
-    team = Team.query.get_or_404(team_id)
-    players = Player.query.filter_by(team_id=team_id).order_by(Player.full_name).all()
+    team = db.get_or_404(Team, team_id)
+    # една групирана заявка вместо по две COUNT заявки за всеки играч
+    stats = db.session.query(
+        Player.full_name,
+        db.func.count(Attendance.id).label('total'),
+        db.func.coalesce(db.func.sum(case((Attendance.status == 'present', 1), else_=0)), 0).label('present')
+    ).outerjoin(Attendance, Attendance.player_id == Player.id) \
+     .filter(Player.team_id == team_id) \
+     .group_by(Player.id, Player.full_name) \
+     .order_by(Player.full_name).all()
     rows = []
-    for p in players:
-        total = Attendance.query.filter_by(player_id=p.id).count()
-        present = Attendance.query.filter_by(player_id=p.id, status='present').count()
+    for full_name, total, present in stats:
         percent = round((present / total * 100) if total>0 else 0,1)
-        rows.append({'full_name': p.full_name, 'total': total, 'present': present, 'percent': percent})
+        rows.append({'full_name': full_name, 'total': total, 'present': present, 'percent': percent})
     return render_template('attendance_stats.html', player=None, total=0, present=0, percent=0, team=team, rows=rows)
 
 import csv
@@ -1842,54 +2013,38 @@ def export_stats_payments():
     start_str = request.args.get('start')
     end_str = request.args.get('end')
 
-    # Парсваме периода
+    # Парсваме периода; без период се взимат всички плащания
+    query = db.session.query(Payment.player_id, Payment.year, Payment.month, Payment.amount, Payment.status)
     if start_str and end_str:
         start_year, start_month = map(int, start_str.split('-'))
         end_year, end_month = map(int, end_str.split('-'))
-    else:
-        # Ако няма подаден период, взимаме целия
-        first_payment = Payment.query.order_by(Payment.year, Payment.month).first()
-        last_payment = Payment.query.order_by(Payment.year.desc(), Payment.month.desc()).first()
-        start_year, start_month = first_payment.year, first_payment.month
-        end_year, end_month = last_payment.year, last_payment.month
-
-    # Всички играчи
-    players = Player.query.order_by(Player.full_name).all()
-
-    # Всички уникални (година, месец) в периода
-    periods = db.session.query(Payment.year, Payment.month) \
-        .filter(
-            (Payment.year > start_year) | ((Payment.year == start_year) & (Payment.month >= start_month)),
-            (Payment.year < end_year) | ((Payment.year == end_year) & (Payment.month <= end_month))
-        ) \
-        .group_by(Payment.year, Payment.month) \
-        .order_by(Payment.year, Payment.month).all()
-
-    # Речник за суми по (player_id, year, month)
-    payments = Payment.query.filter(
-        (Payment.year > start_year) | ((Payment.year == start_year) & (Payment.month >= start_month)),
-        (Payment.year < end_year) | ((Payment.year == end_year) & (Payment.month <= end_month))
-    ).all()
-
-    payments_map = {
-        (p.player_id, p.year, p.month): p.amount if p.status == 'paid' else 0
-        for p in payments
-    }
-
-    # CSV файл
-    si = StringIO()
-    cw = csv.writer(si)
-    header = ["Състезател"] + [f"{m:02d}.{y}" for y, m in periods]
-    cw.writerow(header)
+        # сравнението на (year, month) като двойка позволява range scan по индекса (year, month, ...)
+        query = query.filter(
+            tuple_(Payment.year, Payment.month).between((start_year, start_month), (end_year, end_month))
+        )
 
-    for player in players:
-        row = [player.full_name]
-        for y, m in periods:
-            row.append(payments_map.get((player.id, y, m), 0))
-        cw.writerow(row)
+    # Всички играчи (само нужните колони)
+    players = db.session.query(Player.id, Player.full_name).order_by(Player.full_name).all()
+
+    # Суми по играч {player_id: {(year, month): сума}} и уникалните (година, месец) - с едно минаване;
+    # при дублирани плащания за месеца решава първото по id, както в останалите експорти
+    by_pid = {}
+    periods = set()
+    for player_id, year, month, amount, status in query.order_by(Payment.id):
+        by_pid.setdefault(player_id, {}).setdefault((year, month), amount if status == 'paid' else 0)
+        periods.add((year, month))
+    periods = sorted(periods)
+
+    # CSV файл, ред по ред; играч без плащания получава готовия ред с нули
+    def generate():
+        yield ["Състезател"] + [f"{m:02d}.{y}" for y, m in periods]
+        zeros = [0] * len(periods)
+        for pid, full_name in players:
+            amounts = by_pid.get(pid)
+            yield [full_name] + ([amounts.get(k, 0) for k in periods] if amounts else zeros)
 
     return Response(
-        si.getvalue(),
+        _csv_stream(generate()),
         mimetype="text/csv; charset=utf-8",
         headers={"Content-Disposition": "attachment; filename=payments_detailed.csv"}
     )
@@ -1899,49 +2054,52 @@ from openpyxl.utils import get_column_letter
 from flask import send_file
 import io
 
+def _paid_by_player_month(*criteria):
+    """Платената сума по (играч, месец); при дублирани плащания за месеца решава
+    първото по id, както в CSV експортите. Връща (месеци като 'MM/YYYY' по ред,
+    {player_id: (име, {месец: сума})}) с играчите подредени по име."""
+    first_ids = db.session.query(db.func.min(Payment.id)).filter(*criteria) \
+        .group_by(Payment.player_id, Payment.year, Payment.month)
+    rows = db.session.query(
+        Player.id, Player.full_name, Payment.year, Payment.month,
+        case((Payment.status == 'paid', Payment.amount), else_=0)
+    ).join(Player, Payment.player_id == Player.id).filter(Payment.id.in_(first_ids)) \
+     .order_by(Player.full_name, Player.id, Payment.year, Payment.month).all()
+
+    data = {}
+    periods = set()
+    for player_id, full_name, year, month, amount in rows:
+        periods.add((year, month))
+        data.setdefault(player_id, (full_name, {}))[1][f"{month:02d}/{year}"] = amount
+    months_list = [f"{month:02d}/{year}" for year, month in sorted(periods)]
+    return months_list, data
+
 @app.route('/stats/export/payments_excel')
 @login_required
 @role_required('trainer')
 def export_stats_payments_excel():
-    # Извличаме всички плащания
-    payments = db.session.query(
-        Payment,
-        Player.name.label('player_name')
-    ).join(Player, Payment.player_id == Player.id).order_by(Payment.year, Payment.month).all()
-
-    # Подготвяме структура {играч: {месец/година: сума}}
-    data = {}
-    months_set = set()
+    # Платените суми по играч и месец, агрегирани в базата
+    months_list, data = _paid_by_player_month()
 
-    for p, player_name in payments:
-        key = f"{p.month:02d}/{p.year}"
-        months_set.add(key)
-        if player_name not in data:
-            data[player_name] = {}
-        data[player_name][key] = p.amount if p.status == 'paid' else 0
-
-    months_list = sorted(months_set, key=lambda x: (int(x.split('/')[1]), int(x.split('/')[0])))
+    # Създаваме Excel; write_only пише редовете направо, без да пази клетките
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Плащания")
+    headers = ["Състезател"] + months_list
 
-    # Създаваме Excel
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Плащания"
+    # Авто-ширина (в write_only режим се задава преди редовете)
+    for col in range(1, len(headers) + 1):
+        ws.column_dimensions[get_column_letter(col)].width = 15
 
     # Заглавен ред
-    headers = ["Състезател"] + months_list
     ws.append(headers)
 
     # Данни
-    for player_name, months in data.items():
+    for player_name, months in data.values():
         row = [player_name]
         for m in months_list:
             row.append(months.get(m, 0))
         ws.append(row)
 
-    # Авто-ширина
-    for col in range(1, len(headers) + 1):
-        ws.column_dimensions[get_column_letter(col)].width = 15
-
     # Запис в паметта
     output = io.BytesIO()
     wb.save(output)
@@ -1959,49 +2117,29 @@ def export_stats_payments_excel_v2():
     start = request.args.get('start')
     end = request.args.get('end')
 
-    query = db.session.query(Payment).join(Player)
-
+    criteria = []
     if start:
         start_year, start_month = map(int, start.split('-'))
-        query = query.filter(
-            (Payment.year > start_year) |
-            ((Payment.year == start_year) & (Payment.month >= start_month))
-        )
+        criteria.append(tuple_(Payment.year, Payment.month) >= (start_year, start_month))
 
     if end:
         end_year, end_month = map(int, end.split('-'))
-        query = query.filter(
-            (Payment.year < end_year) |
-            ((Payment.year == end_year) & (Payment.month <= end_month))
-        )
-
-    payments = query.order_by(Player.full_name, Payment.year, Payment.month).all()
-
-    # Подготовка на структура {играч: {месец: сума}}
-    from collections import defaultdict
-    data = defaultdict(lambda: defaultdict(int))
-
-    months_set = set()
+        criteria.append(tuple_(Payment.year, Payment.month) <= (end_year, end_month))
 
-    for p in payments:
-        month_label = f"{p.month:02d}/{p.year}"
-        months_set.add(month_label)
-        data[p.player.full_name][month_label] = p.amount if p.status == 'paid' else 0
-
-    months_list = sorted(months_set, key=lambda x: (int(x.split('/')[1]), int(x.split('/')[0])))
+    # Структура {player_id: (име, {месец: сума})}, подредена по име
+    months_list, data = _paid_by_player_month(*criteria)
 
     # Създаване на Excel
     from openpyxl import Workbook
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Плащания"
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Плащания")
 
     # Заглавен ред
     ws.append(["Състезател"] + months_list)
 
     # Редове с данни
-    for player_name in sorted(data.keys()):
-        row = [player_name] + [data[player_name].get(m, 0) for m in months_list]
+    for player_name, months in data.values():
+        row = [player_name] + [months.get(m, 0) for m in months_list]
         ws.append(row)
 
     # Запис във временно място
@@ -2010,11 +2148,9 @@ def export_stats_payments_excel_v2():
     wb.save(output)
     output.seek(0)
 
-    return Response(
-        output,
-        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        headers={"Content-Disposition": "attachment; filename=payments_stats.xlsx"}
-    )
+    return send_file(output, as_attachment=True,
+                     download_name="payments_stats.xlsx",
+                     mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
 
 
 @app.route('/stats/export/attendance')
@@ -2029,51 +2165,41 @@ def export_stats_attendance():
      .group_by("year", "month") \
      .order_by("year", "month").all()
 
-    si = StringIO()
-    cw = csv.writer(si)
-    cw.writerow(["Месец", "Година", "Средно присъствие %"])
-    for row in attendance_stats:
-        cw.writerow([int(row.month), int(row.year), round(row.attendance_percent * 100, 1)])
+    def generate():
+        yield ["Месец", "Година", "Средно присъствие %"]
+        for row in attendance_stats:
+            yield [int(row.month), int(row.year), round(row.attendance_percent * 100, 1)]
 
     return Response(
-        si.getvalue(),
+        _csv_stream(generate()),
         mimetype="text/csv",
         headers={"Content-Disposition": "attachment; filename=attendance_stats.csv"}
     )
 
 
-# API bind for telegram bot
-@app.route('/api/bind', methods=['POST'])
-
+# JSON отговорите на API-то се сериализират с orjson (C-реализация, по-бърза от json на jsonify)
+def ojson(obj, status=200):
+    return Response(orjson.dumps(obj), status=status, mimetype='application/json')
 
+# API bind for telegram bot
 def normalize_phone(num: str) -> str:
     if not num:
         return ""
-    num = re.sub(r'\D', '', num)  # маха всичко, което не е цифра
+    num = _digits_only(num)  # маха всичко, което не е цифра
     if num.startswith("0") and len(num) == 10:  # 087..., 088...
         num = "359" + num[1:]
     elif num.startswith("00"):  # 00359...
         num = num[2:]
     return num
 
-@app.route('/api/bind', methods=['POST'])
-def api_bind():
-    data = request.get_json(force=True, silent=True)
-    if not data:
-        return jsonify({"ok": False, "error": "no json"}), 400
-    
-    phone = data.get('phone')
-    telegram_id = data.get('telegram_id')
-
-    if not phone or not telegram_id:
-        return jsonify({"ok": False, "error": "missing phone or telegram_id"}), 400
-
+def _bind_phone(phone, telegram_id):
+    """Свързва telegram_id с играчите с този родителски телефон. Връща {'ok', 'matched'}."""
     normalized = normalize_phone(phone)
     phone_to_telegram[normalized] = str(telegram_id)
 
-    # Търсене с нормализиран телефон в базата
+    # кандидатите идват по индексирания parent_phone_norm (последните 9 цифри)
     players = [
-        p for p in Player.query.all()
+        p for p in Player.query.filter_by(parent_phone_norm=normalize_phone_for_match(phone)).all()
         if normalize_phone(p.parent_phone) == normalized
     ]
 
@@ -2084,24 +2210,88 @@ def api_bind():
 
     db.session.commit()
     logger.info(f'Bind: {normalized} -> {telegram_id}, matched {count}')
-    return jsonify({"ok": True, "matched": count})
+    return {"ok": True, "matched": count}
+
+@app.route('/api/bind', methods=['POST'])
+def api_bind():
+    data = request.get_json(force=True, silent=True)
+    if not data:
+        return ojson({"ok": False, "error": "no json"}, 400)
+
+    phone = data.get('phone')
+    telegram_id = data.get('telegram_id')
+
+    if not phone or not telegram_id:
+        return ojson({"ok": False, "error": "missing phone or telegram_id"}, 400)
+
+    return ojson(_bind_phone(phone, telegram_id))
 
 # -------------------- Scheduler --------------------
-scheduler = BackgroundScheduler()
+# Лек планировчик: една daemon нишка за известните периодични задачи (вместо APScheduler).
+_scheduled_jobs = {}  # job_id -> (fn, next_run_fn, run_at)
+_scheduler_lock = threading.Lock()
+_scheduler_thread = None
+
+def _add_job(job_id, fn, next_run):
+    with _scheduler_lock:
+        _scheduled_jobs[job_id] = (fn, next_run, next_run(datetime.now()))
+
+def schedule_interval(job_id, fn, minutes):
+    """Изпълнява fn на всеки `minutes` минути (замества съществуваща задача със същото id)."""
+    _add_job(job_id, fn, lambda now: now + timedelta(minutes=minutes))
+
+def _scheduler_loop():
+    while True:
+        now = datetime.now()
+        due = []
+        with _scheduler_lock:
+            for job_id, (fn, next_run, run_at) in list(_scheduled_jobs.items()):
+                if run_at <= now:
+                    due.append((job_id, fn))
+                    _scheduled_jobs[job_id] = (fn, next_run, next_run(now))
+            wake = min((job[2] for job in _scheduled_jobs.values()), default=now + timedelta(minutes=1))
+        for job_id, fn in due:
+            try:
+                with app.app_context():
+                    fn()
+            except Exception:
+                logger.exception(f'Scheduled job {job_id} failed')
+        # спим до следващата задача, но поне веднъж в минута проверяваме за нови
+        time.sleep(min(max((wake - datetime.now()).total_seconds(), 1), 60))
+
+def start_scheduler():
+    global _scheduler_thread
+    with _scheduler_lock:
+        if _scheduler_thread and _scheduler_thread.is_alive():
+            return
+        _scheduler_thread = threading.Thread(target=_scheduler_loop, name='scheduler', daemon=True)
+        _scheduler_thread.start()
+
+_REMINDER_WORKERS = 20
 
 def send_monthly_reminders():
     today = date.today()
     month = today.month; year = today.year
-    pending = Payment.query.filter_by(year=year, month=month, status='pending').all()
+    pending = Payment.query.options(joinedload(Payment.player)).filter_by(year=year, month=month, status='pending').all()
     logger.info(f'Pending {len(pending)} for {month}/{year}')
-    for p in pending:
-        try:
-            send_email(p.player.email, 'Напомняне за плащане', f'Напомняне: плащане за {p.player.full_name} за {p.month}/{p.year}.')
-            send_telegram(p.player.parent_telegram_id, f'Напомняне: плащане за {p.player.full_name} за {p.month}/{p.year}.')
-        except:
-            logger.exception('Failed monthly reminder')
+    jobs = [(p.player.email, p.player.parent_telegram_id, f'Напомняне: плащане за {p.player.full_name} за {p.month}/{p.year}.')
+            for p in pending]
+    # имейлите се пращат паралелно; Telegram минава през опашката с лимитите на Bot API
+    with ThreadPoolExecutor(max_workers=_REMINDER_WORKERS, thread_name_prefix='reminder') as pool:
+        futures = [pool.submit(send_email, email, 'Напомняне за плащане', text) for email, _, text in jobs if email]
+        for _, chat_id, text in jobs:
+            if chat_id:
+                queue_telegram(chat_id, text)
+        for fut in as_completed(futures):
+            try:
+                fut.result()
+            except Exception:
+                logger.exception('Failed monthly reminder')
 
 # -------------------- Telegram polling bot --------------------
+_PHONE_IN_TEXT_RE = re.compile(r'(\+?\d[\d\s\-()]{4,}\d)')
+_PHONE_SEPARATORS_RE = re.compile(r'[\s\-()]')
+
 def telegram_polling_loop():
     if not TELEGRAM_BOT_TOKEN:
         logger.info("No Telegram token — skipping bot.")
@@ -2109,12 +2299,12 @@ def telegram_polling_loop():
     logger.info("Starting Telegram polling bot")
     offset = None
     base = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}"
-    phone_re = re.compile(r'(\+?\d[\d\s\-()]{4,}\d)')
+    # отговорите минават през опашката, за да не спират long-polling-а
     while True:
         try:
             params = {'timeout':20}
             if offset: params['offset'] = offset
-            resp = requests.get(base + "/getUpdates", params=params, timeout=30)
+            resp = _HTTP.get(base + "/getUpdates", params=params, timeout=30)
             data = resp.json()
             if not data.get('ok'):
                 time.sleep(2); continue
@@ -2124,24 +2314,24 @@ def telegram_polling_loop():
                 if not msg: continue
                 chat = msg.get('chat', {}); chat_id = chat.get('id'); text = msg.get('text','').strip()
                 if text.lower().startswith('/start'):
-                    requests.post(base + "/sendMessage", json={"chat_id": chat_id, "text": "Здравейте! Изпратете номера на родителя (напр. +359888111222) за да се свържете."})
+                    queue_telegram(chat_id, "Здравейте! Изпратете номера на родителя (напр. +359888111222) за да се свържете.")
                     continue
-                m = phone_re.search(text)
+                m = _PHONE_IN_TEXT_RE.search(text)
                 if m:
-                    phone = re.sub(r'[\s\-\(\)]','', m.group(1))
+                    phone = _PHONE_SEPARATORS_RE.sub('', m.group(1))
                     try:
-                        j = {"phone": phone, "telegram_id": chat_id}
-                        r = requests.post("http://127.0.0.1:5000/api/bind", json=j, timeout=5)
-                        if r.ok and r.json().get('ok'):
-                            matched = r.json().get('matched',0)
+                        with app.app_context():
+                            result = _bind_phone(phone, chat_id)
+                        if result.get('ok'):
+                            matched = result.get('matched', 0)
                             reply = f"Телефон {phone} е свързан успешно. Намерени играчи: {matched}."
                         else:
                             reply = f"Опит за свързване направен, но не е намерен състезател."
                     except Exception:
                         logger.exception('Local bind failed'); reply = "Грешка при свързване."
-                    requests.post(base + "/sendMessage", json={"chat_id": chat_id, "text": reply})
+                    queue_telegram(chat_id, reply)
                 else:
-                    requests.post(base + "/sendMessage", json={"chat_id": chat_id, "text": "Моля изпратете телефонния номер на родителя (напр. +359888111222)."})
+                    queue_telegram(chat_id, "Моля изпратете телефонния номер на родителя (напр. +359888111222).")
         except Exception:
             logger.exception('Telegram polling error'); time.sleep(5)
 
@@ -2151,6 +2341,62 @@ def start_telegram_bot_thread():
     logger.info("Telegram bot thread not started — running in webhook mode.")
 
 
+# -------------------- Schema upgrades --------------------
+# дублирани присъствия (за двойка занимание/играч остава записът с най-голямо id)
+_ATT_DUPLICATES_SQL = ('FROM attendance WHERE id NOT IN '
+                       '(SELECT MAX(id) FROM attendance GROUP BY session_id, player_id)')
+
+def upgrade_schema():
+    """Добавя нови колони/индекси към вече съществуващи таблици (db.create_all не го прави)."""
+    player_cols = {c['name'] for c in inspect(db.engine).get_columns('player')}
+    with db.engine.begin() as conn:
+        for col in ('parent_phone_norm', 'player_phone_norm'):
+            if col not in player_cols:
+                conn.execute(text(f'ALTER TABLE player ADD COLUMN {col} VARCHAR(9)'))
+                logger.info(f'Added column player.{col}')
+        # уникалният индекс на присъствията изисква да няма дублирани записи; те не се трият
+        # при стартиране, а изрично с "flask --app app_v3 dedupe-attendance"
+        skip_indexes = set()
+        att_indexes = {ix['name'] for ix in inspect(conn).get_indexes('attendance')}
+        if 'ux_att_session_player' not in att_indexes:
+            dupes = conn.execute(text(f'SELECT COUNT(*) {_ATT_DUPLICATES_SQL}')).scalar()
+            if dupes:
+                logger.warning(f'{dupes} duplicate attendance rows - ux_att_session_player not created, '
+                               f'attendance cannot be saved until "flask --app app_v3 dedupe-attendance" is run')
+                skip_indexes.add('ux_att_session_player')
+            else:
+                conn.execute(text('DROP INDEX IF EXISTS ix_att_session_player'))
+        # индекси, добавени в моделите след създаването на таблиците
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                if index.name not in skip_indexes:
+                    index.create(bind=conn, checkfirst=True)
+    if db.engine.dialect.name == 'postgresql':
+        # trigram индекс, за да може ILIKE '%...%' при търсене по име да ползва индекс
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+                conn.execute(text('CREATE INDEX IF NOT EXISTS ix_player_full_name_trgm '
+                                  'ON player USING gin (full_name gin_trgm_ops)'))
+        except Exception:
+            logger.exception('Could not create trigram index on player.full_name')
+    # попълване на нормализираните телефони за стари записи
+    rows = db.session.query(Player.id, Player.parent_phone, Player.player_phone).filter(
+        db.or_(
+            db.and_(Player.parent_phone.isnot(None), Player.parent_phone_norm.is_(None)),
+            db.and_(Player.player_phone.isnot(None), Player.player_phone_norm.is_(None)),
+        )
+    ).all()
+    if rows:
+        db.session.bulk_update_mappings(Player, [
+            {'id': r.id,
+             'parent_phone_norm': normalize_phone_for_match(r.parent_phone),
+             'player_phone_norm': normalize_phone_for_match(r.player_phone)}
+            for r in rows
+        ])
+        db.session.commit()
+        logger.info(f'Backfilled phone_norm for {len(rows)} players')
+
 # -------------------- Sample data & init --------------------
 def create_sample_data():
     if User.query.count() == 0:
@@ -2185,16 +2431,6 @@ def create_sample_data():
         db.session.commit()
         logger.info('Sample players, payments, trainings created')
 
-def init_app():
-    ensure_templates()
-    with app.app_context():
-        db.create_all()
-        create_sample_data()
-    scheduler.add_job(send_monthly_reminders, 'interval', minutes=60, id='monthly_reminders', replace_existing=True)
-    scheduler.start()
-    start_telegram_bot_thread()
-    logger.info('App initialized')
-
 @app.route('/payments/add', methods=['GET', 'POST'])
 @login_required
 def add_payment():
@@ -2216,27 +2452,27 @@ def add_payment():
         db.session.commit()
 
         # Известяване
-        player = Player.query.get(player_id)
+        player = db.session.get(Player, player_id)
         date_str = f"{month:02d}.{year}"
         message = f"💳 Добавено е ново плащане за {player.full_name} за {date_str} — {amount:.2f} лв."
 
         if player.email:
-            send_email(player.email, "Ново плащане", message)
+            queue_email(player.email, "Ново плащане", message)
         if player.parent_telegram_id:
-            send_telegram(player.parent_telegram_id, message)
+            queue_telegram(player.parent_telegram_id, message)
 
         flash("✅ Плащането е добавено успешно и известието е изпратено", "success")
         return redirect(url_for('payments_list'))
 
-    players = Player.query.all()
-    return render_template('add_payment.html', players=players)
+    return render_template('add_payment.html', players=cached_player_choices())
 
 
 
 @app.route('/api/player/<int:player_id>/payments')
 @login_required
 def get_player_payments(player_id):
-    payments = Payment.query.filter_by(player_id=player_id) \
+    payments = db.session.query(Payment.month, Payment.year, Payment.amount, Payment.status) \
+        .filter_by(player_id=player_id) \
         .order_by(Payment.year.desc(), Payment.month.desc()).all()
 
     history = [
@@ -2249,7 +2485,7 @@ def get_player_payments(player_id):
         }
         for p in payments
     ]
-    return jsonify(history)
+    return ojson(history)
 
 
 @app.route('/payments/pay', methods=['POST'])
@@ -2262,7 +2498,7 @@ def pay_payment():
     amount = request.form.get('amount', type=float)
 
     if not (player_id and month and year):
-        return jsonify({"ok": False, "error": "Missing data"}), 400
+        return ojson({"ok": False, "error": "Missing data"}, 400)
 
     # Търсим съществуващ запис или създаваме нов
     payment = Payment.query.filter_by(player_id=player_id, month=month, year=year).first()
@@ -2286,82 +2522,123 @@ def pay_payment():
     date_str = f"{month:02d}.{year}"
     msg = f"✅ Плащането за {date_str} е получено. Сума: {amount:.2f} лв."
     if player.email:
-        send_email(player.email, "Потвърждение за плащане", msg)
+        queue_email(player.email, "Потвърждение за плащане", msg)
     if player.parent_telegram_id:
-        send_telegram(player.parent_telegram_id, msg)
+        queue_telegram(player.parent_telegram_id, msg)
 
-    return jsonify({"ok": True})
+    return ojson({"ok": True})
 # -------------------- Initialize App --------------------
+def init_db():
+    """Създава таблиците, прилага upgrade_schema и добавя admin потребителя."""
+    db.create_all()
+    upgrade_schema()
+
+    # Create admin user if it doesn't exist
+    admin_user = User.query.filter_by(username='admin').first()
+    if not admin_user:
+        admin_user = User(username='admin', role='admin')
+        admin_user.set_password('admin123')
+        db.session.add(admin_user)
+        db.session.commit()
+        logger.info("Admin user created")
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Еднократна инициализация на базата (flask --app app_v3 init-db), преди стартиране на workers."""
+    with app.app_context():
+        init_db()
+    logger.info('Database initialized')
+
+def dedupe_attendance():
+    """Трие дублираните присъствия и създава уникалния индекс; изтритите редове
+    първо се записват в CSV в instance/. Връща броя изтрити редове."""
+    with db.engine.begin() as conn:
+        res = conn.execute(text(f'SELECT * {_ATT_DUPLICATES_SQL}'))
+        rows = res.all()
+        if rows:
+            path = INSTANCE_DIR / f'attendance_duplicates_{datetime.now():%Y%m%d_%H%M%S}.csv'
+            with open(path, 'w', newline='', encoding='utf-8') as fh:
+                writer = csv.writer(fh)
+                writer.writerow(res.keys())
+                writer.writerows(rows)
+            conn.execute(text(f'DELETE {_ATT_DUPLICATES_SQL}'))
+            logger.warning(f'Removed {len(rows)} duplicate attendance rows (backup: {path})')
+    upgrade_schema()
+    return len(rows)
+
+@app.cli.command('dedupe-attendance')
+def dedupe_attendance_command():
+    """Премахва дублираните присъствия (с backup в CSV) и създава уникалния индекс."""
+    with app.app_context():
+        removed = dedupe_attendance()
+    logger.info(f'Attendance dedupe done, {removed} rows removed')
+
 def init_app():
-    """Initialize the application - create tables and admin user."""
+    """Initialize the application - create tables and admin user, start background jobs."""
     with app.app_context():
-        ensure_templates()
-        db.create_all()
-        
-        # Create admin user if it doesn't exist
-        admin_user = User.query.filter_by(username='admin').first()
-        if not admin_user:
-            admin_user = User(username='admin', role='admin')
-            admin_user.set_password('admin123')
-            db.session.add(admin_user)
-            db.session.commit()
-            logger.info("Admin user created")
-        
+        init_db()
+
         # Set webhook if in production
         maybe_set_webhook()
 
-        # Schedule background jobs
-        try:
-            # Monthly reminders (hourly check)
-            scheduler.add_job(send_monthly_reminders, 'interval', minutes=60, id='monthly_reminders', replace_existing=True)
+    start_background_jobs()
 
-            # Daily materialization wrapper (defers import until run time)
-            def _materialize_wrapper():
-                try:
-                    from datetime import date, timedelta
-                    from app_v3 import materialize_recurring_slots
-                    materialize_recurring_slots(date.today(), date.today() + timedelta(days=7))
-                except Exception:
-                    logger.exception('materialize wrapper failed')
+def start_background_jobs():
+    """Планира периодичните задачи и стартира планировчика в текущия процес."""
+    try:
+        # Monthly reminders (hourly check)
+        schedule_interval('monthly_reminders', send_monthly_reminders, minutes=60)
 
-            scheduler.add_job(_materialize_wrapper, 'cron', hour=3, minute=0, id='materialize_slots_daily', replace_existing=True)
+        # Materialization of recurring slots (every 10 min, next MATERIALIZE_AHEAD_DAYS days)
+        schedule_interval('materialize_slots', scheduled_materialize_upcoming, minutes=10)
 
-            if not scheduler.running:
-                scheduler.start()
-        except Exception:
-            logger.exception('Failed to start scheduler jobs')
-# -------------------- Run --------------------
-if __name__ == '__main__':
-    init_app()
-    app.run(host='0.0.0.0', port=5000, debug=True)
+        start_scheduler()
+    except Exception:
+        logger.exception('Failed to start scheduler jobs')
+
+@app.cli.command('run-scheduler')
+def run_scheduler_command():
+    """Периодичните задачи в отделен процес (Procfile: worker) - не в gunicorn workers,
+    иначе всеки worker би изпращал същите напомняния."""
+    start_background_jobs()
+    if _scheduler_thread is not None:
+        _scheduler_thread.join()
 
 # ---------- Attendance Statistics by Player ----------
+def _attendance_by_player_stats():
+    """Заявка за присъствия по състезатели с името на отбора - един SELECT с JOIN към отборите."""
+    return db.session.query(
+        Player.full_name,
+        Team.name.label("team_name"),
+        db.func.count(Attendance.id).label("total_sessions"),
+        db.func.sum(case((Attendance.status == 'present', 1), else_=0)).label("present_sessions"),
+        # процентът (закръглен до 0.1) се смята в самата заявка
+        db.func.coalesce(db.func.round(
+            db.func.sum(case((Attendance.status == 'present', 1), else_=0)) * 100.0
+            / db.func.nullif(db.func.count(Attendance.id), 0), 1), 0).label("percent")
+    ).join(Attendance, Attendance.player_id == Player.id) \
+     .outerjoin(Team, Team.id == Player.team_id) \
+     .group_by(Player.id, Player.full_name, Team.name) \
+     .order_by(Player.full_name)
+
 @app.route('/stats/attendance_by_player')
 @login_required
 @role_required('trainer')
 def stats_attendance_by_player():
     # Взимаме статистика за присъствие по състезатели
-    attendance_stats = db.session.query(
-        Player.full_name,
-        Player.team_id,
-        db.func.count(Attendance.id).label("total_sessions"),
-        db.func.sum(case((Attendance.status == 'present', 1), else_=0)).label("present_sessions")
-    ).join(Attendance, Attendance.player_id == Player.id) \
-     .group_by(Player.id, Player.full_name, Player.team_id) \
-     .order_by(Player.full_name).all()
+    attendance_stats = _attendance_by_player_stats()
 
     # Изчисляваме процентите
     stats_list = []
     for stat in attendance_stats:
-        percent = round((stat.present_sessions / stat.total_sessions) * 100, 1) if stat.total_sessions > 0 else 0
-        team_name = Team.query.get(stat.team_id).name if stat.team_id else "Без отбор"
+        team_name = stat.team_name or "Без отбор"
         stats_list.append({
             "full_name": stat.full_name,
             "team_name": team_name,
             "total_sessions": stat.total_sessions,
             "present_sessions": stat.present_sessions,
             "absent_sessions": stat.total_sessions - stat.present_sessions,
-            "percent": percent
+            "percent": stat.percent
         })
 
     return render_template('attendance_stats.html', stats=stats_list)
@@ -2370,42 +2647,29 @@ def stats_attendance_by_player():
 @login_required
 @role_required('trainer')
 def stats_attendance_by_player_csv():
-    # Взимаме статистика за присъствие по състезатели
-    attendance_stats = db.session.query(
-        Player.full_name,
-        Player.team_id,
-        db.func.count(Attendance.id).label("total_sessions"),
-        db.func.sum(case((Attendance.status == 'present', 1), else_=0)).label("present_sessions")
-    ).join(Attendance, Attendance.player_id == Player.id) \
-     .group_by(Player.id, Player.full_name, Player.team_id) \
-     .order_by(Player.full_name).all()
-
-    # Генерираме CSV
-    output = StringIO()
-    writer = csv.writer(output)
-
-    # Заглавен ред
-    header = ["Състезател", "Отбор", "Общо тренировки", "Присъствал", "Отсъствал", "Процент присъствие"]
-    writer.writerow(header)
-
-    # Редове за състезатели
-    for stat in attendance_stats:
-        percent = round((stat.present_sessions / stat.total_sessions) * 100, 1) if stat.total_sessions > 0 else 0
-        team_name = Team.query.get(stat.team_id).name if stat.team_id else "Без отбор"
-        row = [
-            stat.full_name,
-            team_name,
-            stat.total_sessions,
-            stat.present_sessions,
-            stat.total_sessions - stat.present_sessions,
-            f"{percent}%"
-        ]
-        writer.writerow(row)
+    # Статистиката се чете на порции по време на изпращането (stream_with_context пази сесията)
+    attendance_stats = _attendance_by_player_stats().yield_per(500)
+
+    # Генерираме CSV ред по ред
+    def generate():
+        # Заглавен ред
+        yield ["Състезател", "Отбор", "Общо тренировки", "Присъствал", "Отсъствал", "Процент присъствие"]
+
+        # Редове за състезатели
+        for stat in attendance_stats:
+            team_name = stat.team_name or "Без отбор"
+            yield [
+                stat.full_name,
+                team_name,
+                stat.total_sessions,
+                stat.present_sessions,
+                stat.total_sessions - stat.present_sessions,
+                f"{stat.percent}%"
+            ]
 
     # Връщаме като отговор за сваляне
-    output.seek(0)
     return Response(
-        output.getvalue(),
+        stream_with_context(_csv_stream(generate())),
         mimetype="text/csv",
         headers={"Content-Disposition": "attachment; filename=attendance_by_player.csv"}
     )
@@ -2415,60 +2679,48 @@ def stats_attendance_by_player_csv():
 @role_required('trainer')
 def stats_attendance_by_player_excel():
     # Взимаме статистика за присъствие по състезатели
-    attendance_stats = db.session.query(
-        Player.full_name,
-        Player.team_id,
-        db.func.count(Attendance.id).label("total_sessions"),
-        db.func.sum(case((Attendance.status == 'present', 1), else_=0)).label("present_sessions")
-    ).join(Attendance, Attendance.player_id == Player.id) \
-     .group_by(Player.id, Player.full_name, Player.team_id) \
-     .order_by(Player.full_name).all()
+    attendance_stats = _attendance_by_player_stats()
 
-    # Създаваме Excel файл
+    # Създаваме Excel файл; write_only пише редовете направо, без да пази клетките
     from openpyxl import Workbook
+    from openpyxl.cell import WriteOnlyCell
     from openpyxl.styles import Font, PatternFill, Alignment
-    
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Статистика присъствие"
+
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Статистика присъствие")
 
     # Стилове
     header_font = Font(bold=True, color="FFFFFF")
     header_fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
     center_alignment = Alignment(horizontal="center", vertical="center")
 
-    # Заглавен ред
+    # Ширините се задават преди редовете (в write_only режим не може след това)
     headers = ["Състезател", "Отбор", "Общо тренировки", "Присъствал", "Отсъствал", "Процент присъствие"]
-    for col, header in enumerate(headers, 1):
-        cell = ws.cell(row=1, column=col, value=header)
+    widths = [30, 20] + [len(h) + 4 for h in headers[2:]]
+    for col, width in enumerate(widths, 1):
+        ws.column_dimensions[get_column_letter(col)].width = width
+
+    # Заглавен ред
+    header_cells = []
+    for header in headers:
+        cell = WriteOnlyCell(ws, value=header)
         cell.font = header_font
         cell.fill = header_fill
         cell.alignment = center_alignment
+        header_cells.append(cell)
+    ws.append(header_cells)
 
     # Данни
-    for row, stat in enumerate(attendance_stats, 2):
-        percent = round((stat.present_sessions / stat.total_sessions) * 100, 1) if stat.total_sessions > 0 else 0
-        team_name = Team.query.get(stat.team_id).name if stat.team_id else "Без отбор"
-        
-        ws.cell(row=row, column=1, value=stat.full_name)
-        ws.cell(row=row, column=2, value=team_name)
-        ws.cell(row=row, column=3, value=stat.total_sessions)
-        ws.cell(row=row, column=4, value=stat.present_sessions)
-        ws.cell(row=row, column=5, value=stat.total_sessions - stat.present_sessions)
-        ws.cell(row=row, column=6, value=f"{percent}%")
-
-    # Автоматично разширяване на колоните
-    for column in ws.columns:
-        max_length = 0
-        column_letter = column[0].column_letter
-        for cell in column:
-            try:
-                if len(str(cell.value)) > max_length:
-                    max_length = len(str(cell.value))
-            except:
-                pass
-        adjusted_width = min(max_length + 2, 50)
-        ws.column_dimensions[column_letter].width = adjusted_width
+    for stat in attendance_stats:
+        team_name = stat.team_name or "Без отбор"
+        ws.append([
+            stat.full_name,
+            team_name,
+            stat.total_sessions,
+            stat.present_sessions,
+            stat.total_sessions - stat.present_sessions,
+            f"{stat.percent}%"
+        ])
 
     # Запазваме файла
     from io import BytesIO
@@ -2476,11 +2728,9 @@ def stats_attendance_by_player_excel():
     wb.save(output)
     output.seek(0)
 
-    return Response(
-        output.getvalue(),
-        mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
-        headers={"Content-Disposition": "attachment; filename=attendance_by_player.xlsx"}
-    )
+    return send_file(output, as_attachment=True,
+                     download_name="attendance_by_player.xlsx",
+                     mimetype="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
 
 # ---------- Admin ----------
 
@@ -2489,9 +2739,9 @@ def stats_attendance_by_player_excel():
 @login_required
 @role_required('trainer')
 def team_players(team_id):
-    team = Team.query.get_or_404(team_id)
+    team = db.get_or_404(Team, team_id)
     players = Player.query.filter_by(team_id=team_id).order_by(Player.full_name).all()
-    all_teams = Team.query.order_by(Team.name).all()
+    all_teams = cached_teams()
     all_players = Player.query.order_by(Player.full_name).all()
     
     return render_template('team_players.html', team=team, players=players, all_teams=all_teams, all_players=all_players)
@@ -2499,62 +2749,63 @@ def team_players(team_id):
 @app.route('/teams/<int:team_id>/players/move', methods=['POST'])
 @login_required
 @role_required('trainer')
-def move_player_to_team():
+def move_player_to_team(team_id):
+    back = url_for('team_players', team_id=team_id)
     player_id = request.form.get('player_id', type=int)
     new_team_id = request.form.get('new_team_id', type=int)
     
     if not player_id or not new_team_id:
         flash('Липсват данни', 'error')
-        return redirect(request.referrer or url_for('teams'))
+        return redirect(back)
     
-    player = Player.query.get_or_404(player_id)
-    new_team = Team.query.get_or_404(new_team_id)
+    player = db.get_or_404(Player, player_id)
+    new_team = db.get_or_404(Team, new_team_id)
     
     old_team_name = player.team.name if player.team else "Без отбор"
     player.team_id = new_team_id
     db.session.commit()
     
     flash(f'Състезателят {player.full_name} е преместен от {old_team_name} в {new_team.name}', 'success')
-    return redirect(request.referrer or url_for('teams'))
+    return redirect(back)
 
 @app.route('/teams/<int:team_id>/players/remove', methods=['POST'])
 @login_required
 @role_required('trainer')
-def remove_player_from_team():
+def remove_player_from_team(team_id):
+    back = url_for('team_players', team_id=team_id)
     player_id = request.form.get('player_id', type=int)
     
     if not player_id:
         flash('Липсват данни', 'error')
-        return redirect(request.referrer or url_for('teams'))
+        return redirect(back)
     
-    player = Player.query.get_or_404(player_id)
+    player = db.get_or_404(Player, player_id)
     team_name = player.team.name if player.team else "Без отбор"
     player.team_id = None
     db.session.commit()
     
     flash(f'Състезателят {player.full_name} е премахнат от {team_name}', 'success')
-    return redirect(request.referrer or url_for('teams'))
+    return redirect(back)
 
 @app.route('/teams/<int:team_id>/players/add', methods=['POST'])
 @login_required
 @role_required('trainer')
-def add_player_to_team():
-    team_id = request.form.get('team_id', type=int)
+def add_player_to_team(team_id):
+    back = url_for('team_players', team_id=team_id)
     player_id = request.form.get('player_id', type=int)
     
-    if not team_id or not player_id:
+    if not player_id:
         flash('Липсват данни', 'error')
-        return redirect(request.referrer or url_for('teams'))
+        return redirect(back)
     
-    player = Player.query.get_or_404(player_id)
-    team = Team.query.get_or_404(team_id)
+    player = db.get_or_404(Player, player_id)
+    team = db.get_or_404(Team, team_id)
     
-    old_team_name = player.team.name if player.team else "Без отбор"
     player.team_id = team_id
     db.session.commit()
     
     flash(f'Състезателят {player.full_name} е добавен в {team.name}', 'success')
-    return redirect(request.referrer or url_for('teams'))
+    return redirect(back)
 
 # ---------- Admin ----------
 
@@ -2569,7 +2820,7 @@ def api_calendar_events():
     start = request.args.get('start')
     end = request.args.get('end')
 
-    # Determine range and materialize sessions from recurring slots automatically
+    # Determine range (sessions from recurring slots are materialized by the run-scheduler worker)
     try:
         range_start = datetime.fromisoformat(start[:10]).date() if start else date.today()
     except Exception:
@@ -2579,54 +2830,32 @@ def api_calendar_events():
     except Exception:
         range_end = range_start + timedelta(days=14)
 
-    # Create TrainingSession from active season slots for the requested period
-    try:
-        materialize_recurring_slots(range_start, range_end)
-    except Exception:
-        logger.exception('materialize_recurring_slots during /api/calendar/events failed')
-
-    q = TrainingSession.query
+    q = TrainingSession.query.options(joinedload(TrainingSession.team))
     q = q.filter(TrainingSession.date >= range_start, TrainingSession.date <= range_end)
 
     sessions = q.order_by(TrainingSession.date.asc()).all()
 
-    def guess_venue(notes: str) -> str:
-        if not notes:
-            return ''
-        text = notes.strip().upper()
-        if 'НУПИ' in text:
-            return 'НУПИ'
-        if 'ЧАВДАР' in text:
-            return 'ЧАВДАР'
-        if 'СТАДИОН' in text:
-            return 'СТАДИОН'
-        return ''
-
-    # използваме централизираната цветова функция
-    def team_color_for(name: str) -> str:
-        return team_color_for_name(name)
-
     events = []
     for s in sessions:
         start_time = (s.start_time or '08:00')
         end_time = (s.end_time or '09:00')
         start_iso = f"{s.date.isoformat()}T{start_time}:00"
         end_iso = f"{s.date.isoformat()}T{end_time}:00"
-        team_name = Team.query.get(s.team_id).name if s.team_id else '—'
-        color = team_color_for(team_name)
+        team_name = s.team.name if s.team else '—'
+        color = team_color_for_name(team_name)  # lru_cache - изчислява се веднъж на отбор
         events.append({
             'id': f'tr-{s.id}',
             'title': team_name,
             'start': start_iso,
             'end': end_iso,
-            'venue': guess_venue(s.notes or ''),
+            'venue': guess_venue(s.notes),
             'edit_url': url_for('edit_training', training_id=s.id),
             'team_color': color
         })
 
     # We no longer render raw recurring slots here because they are materialized above.
 
-    return jsonify(events)
+    return ojson(events)
 
 # -------- Season & Recurring slots (basic admin) --------
 @app.route('/admin/seasons', methods=['GET','POST'])
@@ -2654,7 +2883,7 @@ def manage_seasons():
 @role_required('admin')
 def manage_recurring_slots():
     seasons = Season.query.order_by(Season.id.desc()).all()
-    teams = Team.query.order_by(Team.name).all()
+    teams = cached_teams()
     if request.method == 'POST':
         season_id = request.form.get('season_id', type=int)
         team_id = request.form.get('team_id', type=int)
@@ -2674,19 +2903,23 @@ def manage_recurring_slots():
 @app.route('/admin/slots/<int:slot_id>/delete', methods=['POST'])
 @role_required('admin')
 def delete_recurring_slot(slot_id):
-    slot = RecurringSlot.query.get_or_404(slot_id)
+    slot = db.get_or_404(RecurringSlot, slot_id)
     db.session.delete(slot)
     db.session.commit()
     flash('Слотът е изтрит','success')
     return redirect(url_for('manage_recurring_slots'))
 
+def _delete_all_training_sessions():
+    """Изтрива присъствията и всички тренировки (без commit). Връща броя изтрити тренировки."""
+    # FK-то към training_session няма ON DELETE CASCADE в съществуващите бази, затова присъствията са отделно
+    Attendance.query.delete()
+    return db.session.execute(db.delete(TrainingSession)).rowcount
+
 @app.route('/admin/slots/delete_all', methods=['POST'])
 @role_required('admin')
 def delete_all_trainings():
     """Изтриване на всички TrainingSession (чистене на стар график)."""
-    count = TrainingSession.query.count()
-    Attendance.query.delete()
-    db.session.execute(db.delete(TrainingSession))
+    count = _delete_all_training_sessions()
     db.session.commit()
     flash(f'Изтрити тренировки: {count}','success')
     return redirect(url_for('trainings'))
@@ -2709,25 +2942,23 @@ def seed_summer_season():
         season.is_active = True
         db.session.commit()
 
-    def team_by_name(n):
-        return Team.query.filter_by(name=n).first()
+    # {име на отбор: id} с една заявка; при еднакви имена печели най-малкото id
+    team_ids = dict(db.session.query(Team.name, Team.id).order_by(Team.id.desc()))
 
     slots = []
     # Helper to append slot
     def add_slot(weekday, start_time, end_time, venue, team_label):
         # Нормализирани етикети според графика
         name = _normalize_team_label(team_label)
-        t = team_by_name(name)
-        team_id = t.id if t else None
-        slots.append(RecurringSlot(
-            season_id=season.id,
-            team_id=team_id,
-            weekday=weekday,
-            start_time=start_time,
-            end_time=end_time,
-            venue=venue,
-            title=name
-        ))
+        slots.append({
+            'season_id': season.id,
+            'team_id': team_ids.get(name),
+            'weekday': weekday,
+            'start_time': start_time,
+            'end_time': end_time,
+            'venue': venue,
+            'title': name
+        })
 
     # Понеделник (0)
     add_slot(0, '08:00', '09:00', 'СТАДИОН', 'U-12 Ж')
@@ -2764,7 +2995,7 @@ def seed_summer_season():
 
     # Save (clear previous slots of the season)
     RecurringSlot.query.filter_by(season_id=season.id).delete()
-    db.session.add_all(slots)
+    db.session.bulk_insert_mappings(RecurringSlot, slots)
     db.session.commit()
     flash('Летният график е въведен и сезонът е активен.','success')
     return redirect(url_for('manage_recurring_slots'))
@@ -2786,20 +3017,19 @@ def seed_from_image():
 
     ensure_schedule_teams()
 
-    def team_id_by(name):
-        t = Team.query.filter_by(name=name).first()
-        return t.id if t else None
+    # {име на отбор: id} с една заявка; при еднакви имена печели най-малкото id
+    team_ids = dict(db.session.query(Team.name, Team.id).order_by(Team.id.desc()))
 
     def add(weekday, start_time, end_time, venue, title):
-        return RecurringSlot(
-            season_id=season.id,
-            team_id=team_id_by(title),
-            weekday=weekday,
-            start_time=start_time,
-            end_time=end_time,
-            venue=venue,
-            title=title
-        )
+        return {
+            'season_id': season.id,
+            'team_id': team_ids.get(title),
+            'weekday': weekday,
+            'start_time': start_time,
+            'end_time': end_time,
+            'venue': venue,
+            'title': title
+        }
 
     slots = [
         # Понеделник (0)
@@ -2833,12 +3063,11 @@ def seed_from_image():
 
     # Clear previous slots of the season and all future materialized trainings
     RecurringSlot.query.filter_by(season_id=season.id).delete()
-    db.session.add_all(slots)
+    db.session.bulk_insert_mappings(RecurringSlot, slots)
     db.session.commit()
 
     # По желание: изчистваме всички тренировки (стар график)
-    Attendance.query.delete()
-    db.session.execute(db.delete(TrainingSession))
+    _delete_all_training_sessions()
     db.session.commit()
 
     flash('Графикът от снимката е въведен. Старите тренировки са изтрити.','success')
@@ -2854,91 +3083,131 @@ SCHEDULE_TEAM_NAMES = [
     'Старша',
 ]
 
+# Проверката се прави веднъж, докато някой отбор не се промени (календарът я вика при всяко зареждане).
+_schedule_teams_ready = False
+
+def _reset_schedule_teams(*_args):
+    global _schedule_teams_ready
+    _schedule_teams_ready = False
+
+invalidate_after_commit(_reset_schedule_teams, Team)
+
+# Стари/демо имена -> имена от графика: (ново име, варианти), като вариантът е
+# набор от поднизове, които трябва всички да се срещат в името (с малки букви).
+_TEAM_RENAME_RULES = (
+    ('U-12 Ж', (('u12', 'girls'), ('момичета до 12',))),
+    ('U-12 М', (('u12', 'boys'), ('момчета', '12'))),
+    ('U-18 Ж', (('u18', 'girls'), ('момичета', '18'))),
+    ('U-18 М', (('u18', 'boys'), ('момчета', '18'), ('мъже',))),
+    ('Старша', (('senior',), ('старша',))),
+)
+
 def ensure_schedule_teams():
     """Ensure teams matching schedule names exist. Optionally rename default U* teams."""
-    existing_by_name = {t.name: t for t in Team.query.all()}
+    global _schedule_teams_ready
+    if _schedule_teams_ready:
+        return
+    teams = Team.query.all()
+    existing_by_name = {t.name: t for t in teams}
 
     # Try to normalize some demo names into the new scheme
-    rename_map = {}
-    for t in Team.query.all():
+    rename_map = []
+    for t in teams:
         lname = (t.name or '').lower()
-        if ('u12' in lname and 'girls' in lname) or 'момичета до 12' in lname:
-            rename_map[t.id] = 'U-12 Ж'
-        elif ('u12' in lname and 'boys' in lname) or ('момчета' in lname and '12' in lname):
-            rename_map[t.id] = 'U-12 М'
-        elif ('u18' in lname and 'girls' in lname) or ('момичета' in lname and '18' in lname):
-            rename_map[t.id] = 'U-18 Ж'
-        elif ('u18' in lname and 'boys' in lname) or ('момчета' in lname and '18' in lname) or ('мъже' in lname):
-            rename_map[t.id] = 'U-18 М'
-        elif 'senior' in lname or 'старша' in lname:
-            rename_map[t.id] = 'Старша'
+        for new_name, alternatives in _TEAM_RENAME_RULES:
+            if any(all(part in lname for part in parts) for parts in alternatives):
+                rename_map.append((t, new_name))
+                break
     # Apply renames if target name not already taken
-    for team_id, new_name in rename_map.items():
+    for t, new_name in rename_map:
         if new_name not in existing_by_name:
-            t = Team.query.get(team_id)
-            if t:
-                t.name = new_name
-                existing_by_name[new_name] = t
+            t.name = new_name
+            existing_by_name[new_name] = t
     # Ensure all schedule teams exist
     for n in SCHEDULE_TEAM_NAMES:
         if n not in existing_by_name:
             db.session.add(Team(name=n))
     db.session.commit()
+    _schedule_teams_ready = True
 
-def resolve_team_id_for_slot(slot: RecurringSlot) -> Optional[int]:
+def resolve_team_id_for_slot(slot: RecurringSlot, name_to_id: Optional[dict] = None) -> Optional[int]:
+    """name_to_id: {име на отбор: id}, зареден веднъж от извикващия; допълва се при нов отбор."""
     if slot.team_id:
         return slot.team_id
     # try match by title
     title = (slot.title or '').strip()
     if not title:
         return None
-    team = Team.query.filter_by(name=title).first()
-    if not team:
+    if name_to_id is None:
+        team = Team.query.filter_by(name=title).first()
+        team_id = team.id if team else None
+    else:
+        team_id = name_to_id.get(title)
+    if team_id is None:
         team = Team(name=title)
         db.session.add(team)
         db.session.commit()
-    return team.id
+        team_id = team.id
+        if name_to_id is not None:
+            name_to_id[title] = team_id
+    return team_id
 
 def materialize_recurring_slots(range_start: date, range_end: date) -> int:
     """Create TrainingSession rows from active season RecurringSlot in the given range.
     Returns number of created sessions.
     """
-    created = 0
     active_season = Season.query.filter_by(is_active=True).first()
     if not active_season:
         return 0
     ensure_schedule_teams()
     slots = RecurringSlot.query.filter_by(season_id=active_season.id).all()
-    d = range_start
-    while d <= range_end:
-        for slot in slots:
-            if d.weekday() != slot.weekday:
-                continue
-            team_id = resolve_team_id_for_slot(slot)
-            # prevent duplicates by (team_id, date, start_time)
-            exists = TrainingSession.query.filter_by(
-                team_id=team_id, date=d, start_time=slot.start_time
-            ).first()
-            if exists:
-                continue
-            ts = TrainingSession(
-                team_id=team_id,
-                date=d,
-                start_time=slot.start_time,
-                end_time=slot.end_time,
-                notes=slot.venue or slot.title or ''
-            )
-            db.session.add(ts)
-            created += 1
-        d = d + timedelta(days=1)
-    if created:
+    # вече създадените тренировки в периода - с една заявка вместо проверка за всеки ден и слот
+    existing = set(db.session.query(
+        TrainingSession.team_id, TrainingSession.date, TrainingSession.start_time
+    ).filter(TrainingSession.date.between(range_start, range_end)))
+    # датите на всеки слот се генерират директно (първият му ден от седмицата + 7 дни),
+    # вместо да се обхожда всеки ден от периода; редът остава по дата, после по слот
+    occurrences = []
+    for idx, slot in enumerate(slots):
+        if slot.weekday not in range(7):
+            continue
+        d = range_start + timedelta(days=(slot.weekday - range_start.weekday()) % 7)
+        while d <= range_end:
+            occurrences.append((d, idx, slot))
+            d += timedelta(days=7)
+    occurrences.sort(key=itemgetter(0, 1))
+    # отборът на слот се определя веднъж (при първа нужда)
+    slot_team_ids = {}
+    name_to_id = dict(db.session.query(Team.name, Team.id).order_by(Team.id.desc()))
+    new_rows = []
+    for d, _, slot in occurrences:
+        if slot.id not in slot_team_ids:
+            slot_team_ids[slot.id] = resolve_team_id_for_slot(slot, name_to_id)
+        team_id = slot_team_ids[slot.id]
+        # prevent duplicates by (team_id, date, start_time)
+        key = (team_id, d, slot.start_time)
+        if key in existing:
+            continue
+        existing.add(key)
+        new_rows.append({
+            'team_id': team_id,
+            'date': d,
+            'start_time': slot.start_time,
+            'end_time': slot.end_time,
+            'notes': slot.venue or slot.title or ''
+        })
+    if new_rows:
+        db.session.bulk_insert_mappings(TrainingSession, new_rows)
         db.session.commit()
-    return created
+    return len(new_rows)
+
+# колко дни напред се материализират слотовете от планировчика (календарът само чете)
+MATERIALIZE_AHEAD_DAYS = 30
 
 def scheduled_materialize_upcoming():
     try:
         with app.app_context():
-            materialize_recurring_slots(date.today(), date.today() + timedelta(days=7))
+            materialize_recurring_slots(date.today(), date.today() + timedelta(days=MATERIALIZE_AHEAD_DAYS))
     except Exception:
         logger.exception('scheduled_materialize_upcoming failed')
 
@@ -2976,3 +3245,9 @@ def admin_materialize_month():
     created = materialize_recurring_slots(start, end)
     flash(f'Материализирани тренировки за {m:02d}.{y}: {created}', 'success')
     return redirect(url_for('trainings', year=y, month=m))
+
+# -------------------- Run --------------------
+# в края на модула, за да са регистрирани всички routes и функции преди app.run
+if __name__ == '__main__':
+    init_app()
+    app.run(host='0.0.0.0', port=5000, debug=True)
@@ -4,13 +4,15 @@ Database migration script for Trenera application
 """
 import os
 import sys
+import csv
+from datetime import date, datetime
 from pathlib import Path
 
 # Add the project root to Python path
 project_root = Path(__file__).parent
 sys.path.insert(0, str(project_root))
 
-from app_v3 import app, db, User, Team, Player, Payment, TrainingSession, Attendance
+from app_v3 import app, db, upgrade_schema, normalize_phone_for_match, User, Team, Player, Payment, TrainingSession, Attendance
 from werkzeug.security import generate_password_hash
 
 def create_admin_user():
@@ -46,11 +48,23 @@ def create_sample_teams():
         else:
             print("ℹ️ Teams already exist")
 
+def _write_csv(path, rows):
+    """Write a list of dicts to CSV (header from the first row's keys)"""
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+
+def _read_csv(path):
+    """Read CSV rows as dicts; empty cells become None"""
+    with open(path, newline='', encoding='utf-8') as f:
+        return [{k: (v if v != '' else None) for k, v in row.items()} for row in csv.DictReader(f)]
+
+def _int(value):
+    return int(float(value)) if value is not None else None
+
 def backup_sqlite_data():
     """Backup SQLite data to CSV files"""
-    import pandas as pd
-    from datetime import datetime
-    
     backup_dir = Path("backup") / datetime.now().strftime("%Y%m%d_%H%M%S")
     backup_dir.mkdir(parents=True, exist_ok=True)
     
@@ -71,7 +85,7 @@ def backup_sqlite_data():
                     'notes': p.notes,
                     'team_id': p.team_id
                 })
-            pd.DataFrame(players_data).to_csv(backup_dir / "players.csv", index=False)
+            _write_csv(backup_dir / "players.csv", players_data)
             print(f"✅ Players backed up to {backup_dir / 'players.csv'}")
         
         # Backup payments
@@ -89,7 +103,7 @@ def backup_sqlite_data():
                     'paid_at': p.paid_at.isoformat() if p.paid_at else None,
                     'note': p.note
                 })
-            pd.DataFrame(payments_data).to_csv(backup_dir / "payments.csv", index=False)
+            _write_csv(backup_dir / "payments.csv", payments_data)
             print(f"✅ Payments backed up to {backup_dir / 'payments.csv'}")
         
         # Backup teams
@@ -103,13 +117,11 @@ def backup_sqlite_data():
                     'age_group': t.age_group,
                     'gender': t.gender
                 })
-            pd.DataFrame(teams_data).to_csv(backup_dir / "teams.csv", index=False)
+            _write_csv(backup_dir / "teams.csv", teams_data)
             print(f"✅ Teams backed up to {backup_dir / 'teams.csv'}")
 
 def restore_from_csv():
     """Restore data from CSV backup files"""
-    import pandas as pd
-    
     backup_dir = Path("backup")
     if not backup_dir.exists():
         print("❌ No backup directory found")
@@ -128,68 +140,54 @@ def restore_from_csv():
         # Restore teams
         teams_file = latest_backup / "teams.csv"
         if teams_file.exists():
-            teams_df = pd.read_csv(teams_file)
-            for _, row in teams_df.iterrows():
-                team = Team.query.get(row['id'])
-                if not team:
-                    team = Team(
-                        id=row['id'],
-                        name=row['name'],
-                        age_group=row['age_group'],
-                        gender=row['gender']
-                    )
-                    db.session.add(team)
+            existing = {r[0] for r in db.session.query(Team.id)}
+            to_insert = [{
+                'id': _int(row['id']),
+                'name': row['name'],
+                'age_group': row['age_group'],
+                'gender': row['gender']
+            } for row in _read_csv(teams_file) if _int(row['id']) not in existing]
+            db.session.bulk_insert_mappings(Team, to_insert)
             db.session.commit()
             print("✅ Teams restored")
         
         # Restore players
         players_file = latest_backup / "players.csv"
         if players_file.exists():
-            players_df = pd.read_csv(players_file)
-            for _, row in players_df.iterrows():
-                player = Player.query.get(row['id'])
-                if not player:
-                    birth_date = None
-                    if pd.notna(row['birth_date']):
-                        birth_date = pd.to_datetime(row['birth_date']).date()
-                    
-                    player = Player(
-                        id=row['id'],
-                        full_name=row['full_name'],
-                        birth_date=birth_date,
-                        player_phone=row['player_phone'],
-                        parent_phone=row['parent_phone'],
-                        parent_telegram_id=row['parent_telegram_id'],
-                        email=row['email'],
-                        notes=row['notes'],
-                        team_id=row['team_id']
-                    )
-                    db.session.add(player)
+            existing = {r[0] for r in db.session.query(Player.id)}
+            to_insert = [{
+                'id': _int(row['id']),
+                'full_name': row['full_name'],
+                'birth_date': date.fromisoformat(row['birth_date']) if row['birth_date'] else None,
+                'player_phone': row['player_phone'],
+                # bulk insert-ът не минава през ORM събитията, затова *_phone_norm се попълват тук
+                'player_phone_norm': normalize_phone_for_match(row['player_phone']),
+                'parent_phone': row['parent_phone'],
+                'parent_phone_norm': normalize_phone_for_match(row['parent_phone']),
+                'parent_telegram_id': row['parent_telegram_id'],
+                'email': row['email'],
+                'notes': row['notes'],
+                'team_id': _int(row['team_id'])
+            } for row in _read_csv(players_file) if _int(row['id']) not in existing]
+            db.session.bulk_insert_mappings(Player, to_insert)
             db.session.commit()
             print("✅ Players restored")
         
         # Restore payments
         payments_file = latest_backup / "payments.csv"
         if payments_file.exists():
-            payments_df = pd.read_csv(payments_file)
-            for _, row in payments_df.iterrows():
-                payment = Payment.query.get(row['id'])
-                if not payment:
-                    paid_at = None
-                    if pd.notna(row['paid_at']):
-                        paid_at = pd.to_datetime(row['paid_at'])
-                    
-                    payment = Payment(
-                        id=row['id'],
-                        player_id=row['player_id'],
-                        year=row['year'],
-                        month=row['month'],
-                        amount=row['amount'],
-                        status=row['status'],
-                        paid_at=paid_at,
-                        note=row['note']
-                    )
-                    db.session.add(payment)
+            existing = {r[0] for r in db.session.query(Payment.id)}
+            to_insert = [{
+                'id': _int(row['id']),
+                'player_id': _int(row['player_id']),
+                'year': _int(row['year']),
+                'month': _int(row['month']),
+                'amount': float(row['amount'] or 0),
+                'status': row['status'],
+                'paid_at': datetime.fromisoformat(row['paid_at']) if row['paid_at'] else None,
+                'note': row['note']
+            } for row in _read_csv(payments_file) if _int(row['id']) not in existing]
+            db.session.bulk_insert_mappings(Payment, to_insert)
             db.session.commit()
             print("✅ Payments restored")
 
@@ -207,6 +205,7 @@ if __name__ == "__main__":
         print("🚀 Initializing database...")
         with app.app_context():
             db.create_all()
+            upgrade_schema()
         create_admin_user()
         create_sample_teams()
         print("✅ Database initialized successfully!")